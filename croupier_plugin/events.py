@@ -0,0 +1,127 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+events.py: Follows the state transitions logged by the jobs
+'''
+
+
+import logging
+import threading
+import time
+
+from paramiko import ssh_exception
+
+from croupier_plugin.ssh import SshClient, SshTimeoutError
+from croupier_plugin.workload_managers.workload_manager import (
+    JOBSTATESDICT,
+    events_path)
+
+# Seconds a follower command runs before it is started again
+FOLLOW_TIMEOUT = 3600
+
+# Seconds to wait before following again a log after an error
+FOLLOW_RETRY = 30
+
+
+class EventFollower(object):
+    """ Follows the events log of a working directory over a long-lived ssh
+    channel, keeping the last state logged of each job and when it was
+    received. Lines already read are skipped when the channel is opened
+    again. """
+
+    def __init__(self, credentials, workdir, logger=None):
+        self.credentials = credentials
+        self.workdir = workdir
+        self.logger = logger or logging.getLogger(__name__)
+        self.connected = False
+        self._events = {}
+        self._lines = 0
+        self._client = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._follow)
+        self._thread.daemon = True
+
+    def start(self):
+        """ Starts following the log in the background """
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops following the log """
+        self._stopped.set()
+        with self._lock:
+            if self._client is not None:
+                self._client.close_connection()
+
+    @property
+    def alive(self):
+        """ True if the log is being followed """
+        return self.connected and not self._stopped.is_set()
+
+    def events(self):
+        """ Dictionary of job names and their last (time received, state) """
+        with self._lock:
+            return dict(self._events)
+
+    def _follow(self):
+        while not self._stopped.is_set():
+            try:
+                self._follow_once()
+            except SshTimeoutError:
+                continue  # follow again on a fresh channel
+            except (ssh_exception.SSHException, EnvironmentError,
+                    EOFError) as err:
+                self.logger.warning("Lost the events of '" + self.workdir +
+                                    "': " + str(err))
+            finally:
+                self.connected = False
+            self._stopped.wait(FOLLOW_RETRY)
+
+    def _follow_once(self):
+        client = SshClient(self.credentials)
+        with self._lock:
+            if self._stopped.is_set():
+                client.close_connection()
+                return
+            self._client = client
+        try:
+            # -F keeps following the log if it is created or replaced later
+            stream = client.stream_command(
+                "tail -n +" + str(self._lines + 1) + " -F " +
+                events_path(self.workdir) + " 2>/dev/null",
+                exec_timeout=FOLLOW_TIMEOUT)
+            self.connected = True
+            with stream:
+                for line in stream:
+                    if not line.endswith('\n'):
+                        break  # cut, read again next time
+                    self._lines += 1
+                    self._add_event(line)
+        finally:
+            with self._lock:
+                self._client = None
+            client.close_connection()
+
+    def _add_event(self, line):
+        parts = line.split()
+        if len(parts) != 2 or parts[1] not in JOBSTATESDICT:
+            return  # partially written or not an event
+        with self._lock:
+            self._events[parts[0]] = (time.time(), parts[1])
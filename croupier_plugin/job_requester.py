@@ -25,84 +25,454 @@ job_requester.py: Holds the functions that requests jobs information
 '''
 
 
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import stat
+import tempfile
 import time
+from contextlib import contextmanager
+from multiprocessing import TimeoutError
 from threading import Lock
 
 import requests
+from paramiko import ssh_exception
 
+from croupier_plugin import prometheus
+from croupier_plugin.events import EventFollower
+from croupier_plugin.ssh import (
+    Deadline,
+    SshCircuitOpenError,
+    SshTimeoutError,
+    run_async)
 from croupier_plugin.workload_managers.workload_manager import (
     WorkloadManager,
-    state_int_to_str)
+    parse_max_time)
+
+# Max seconds to get the status of the jobs of a host
+MONITOR_TIMEOUT = 60
+
+# Extra seconds given to a host query to notice its own timeout
+MONITOR_GRACE = 5
+
+# Max times the monitor period of a host is stretched for jobs that stay
+# queued, and for jobs in any other state
+MAX_BACKOFF = 16
+MAX_ACTIVE_BACKOFF = 2
+
+# Times the poll period of a host is stretched while the events of all its
+# jobs are followed, to reconcile states the jobs could not log
+EVENTS_RECONCILE = 10
+
+# Max status queries sent to a host in QUERY_BUDGET_PERIOD seconds, by all
+# the workflow executions of the manager
+QUERY_BUDGET = 6
+QUERY_BUDGET_PERIOD = 60
+
+# Where the query budgets of the hosts are shared between executions, only
+# the user of the manager may access it
+QUERY_BUDGET_DIR = os.path.join(tempfile.gettempdir(),
+                                'croupier_budgets_' + str(os.getuid()))
+
+# Seconds the states read from a host are shared with other executions
+SHARED_STATES_TTL = 3600
+
+# States which are polled on every monitor period
+_TRANSIENT_STATES = ('CONFIGURING', 'COMPLETING', 'STOPPED', 'SUSPENDED')
+
+# States of the jobs waiting in the queue
+_QUEUED_STATES = ('PENDING',)
+
+# States of the jobs that are over, which are not tracked anymore
+_FINAL_STATES = ('BOOT_FAIL', 'CANCELLED', 'COMPLETED', 'DEADLINE',
+                 'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED',
+                 'REVOKED', 'TIMEOUT')
+
+
+class QueryBudgetError(EnvironmentError):
+    """ Raised when the query budgets can't be kept safely """
+    pass
+
+
+class QueryBudget(object):
+    """ Token bucket per host, kept in a locked file so every workflow
+    execution of the manager takes from the same budget. The last states
+    read from a host are kept in the same file, to answer the executions
+    that run out of budget. Raises QueryBudgetError if the budgets can't
+    be kept in the directory, or anyone else may change them. """
+
+    def __init__(self,
+                 directory=QUERY_BUDGET_DIR,
+                 budget=QUERY_BUDGET,
+                 period=QUERY_BUDGET_PERIOD):
+        self.directory = directory
+        self.budget = budget
+        self.period = period
+
+    def acquire(self, host):
+        """ Takes a query from the budget of the host, False if it is
+        exhausted """
+        return self.take(host) == 0
+
+    def take(self, host):
+        """ Takes a query from the budget of the host. Returns 0 if taken,
+        or the seconds until the budget has a query again if exhausted. """
+        with self._open(host) as bucket:
+            now = time.time()
+            tokens = min(self.budget,
+                         bucket.get('tokens', self.budget) +
+                         max(0, now - bucket.get('time', now)) *
+                         self.budget / float(self.period))
+            bucket['time'] = now
+            if tokens < 1:
+                bucket['tokens'] = tokens
+                return (1 - tokens) * self.period / float(self.budget)
+            bucket['tokens'] = tokens - 1
+            return 0
+
+    def share(self, host, states):
+        """ Keeps the last states read from a host for other executions,
+        for SHARED_STATES_TTL seconds """
+        with self._open(host) as bucket:
+            now = time.time()
+            shared = dict(
+                (name, entry)
+                for name, entry in bucket.get('states', {}).iteritems()
+                if isinstance(entry, list) and
+                now - entry[0] < SHARED_STATES_TTL)
+            shared.update((name, [now, state])
+                          for name, state in states.iteritems())
+            bucket['states'] = shared
+
+    def shared_states(self, host):
+        """ Last states read from a host by any execution """
+        with self._open(host) as bucket:
+            now = time.time()
+            return dict(
+                (name, entry[1])
+                for name, entry in bucket.get('states', {}).iteritems()
+                if isinstance(entry, list) and
+                now - entry[0] < SHARED_STATES_TTL)
+
+    @contextmanager
+    def _open(self, host):
+        """ Bucket of a host, locked and written back on exit """
+        self._check_directory()
+        path = os.path.join(self.directory,
+                            hashlib.sha1(host).hexdigest() + '.json')
+        try:
+            bucket_file = os.fdopen(
+                os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600),
+                'r+')
+        except (IOError, OSError) as err:
+            raise QueryBudgetError("Query budget of '" + host +
+                                   "' can't be used: " + str(err))
+        with bucket_file:
+            fcntl.flock(bucket_file, fcntl.LOCK_EX)
+            try:
+                bucket = json.loads(bucket_file.read() or '{}')
+            except ValueError:  # broken, start again
+                bucket = {}
+            yield bucket
+            bucket_file.seek(0)
+            bucket_file.truncate()
+            json.dump(bucket, bucket_file)
+
+    def _check_directory(self):
+        """ Creates the directory of the budgets if missing, and checks
+        that only its owner, the user of the manager, may access it """
+        try:
+            os.makedirs(self.directory, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise QueryBudgetError("Query budgets directory '" +
+                                       self.directory +
+                                       "' can't be created: " + str(err))
+        info = os.lstat(self.directory)
+        if not stat.S_ISDIR(info.st_mode) or \
+                info.st_uid != os.getuid() or info.st_mode & 0o077:
+            raise QueryBudgetError("Query budgets directory '" +
+                                   self.directory + "' must be a directory "
+                                   "only accessible by its owner, user " +
+                                   str(os.getuid()))
+
+
+class _JobTrack(object):
+    """ Last state seen of a job, and since when """
+
+    def __init__(self, state, now):
+        self.state = state
+        self.since = now
+        self.unchanged = 0  # polls since the state was seen
 
 
 class JobRequester(object):
     """ Safely gets the jobs status when requested """
     class __JobRequester(object):
         _last_time = {}
+        _last_states = {}
+        _jobs = {}
+        _followers = {}
+        _throttled = {}  # host: time its budget has a query again
+        _budget = QueryBudget()
+        _stats = {'hits': 0, 'misses': 0, 'throttled': 0,
+                  'invalidations': 0}
         _lock = Lock()
 
         def request(self, monitor_jobs, logger):
-            """ Retrieves the status of every job"""
+            """ Retrieves the status of every job, querying the hosts in
+            parallel. Hosts polled less than their poll period ago are
+            answered from memory, hosts out of query budget with the last
+            states read by any execution, and hosts not answering in time
+            keep their last known states. States logged by the jobs of hosts
+            with 'events' settings prevail when newer than the last poll.
+            The query budget is the one of the 'host' settings, if they set
+            one other than the key of the jobs. """
             states = {}
-
+            pending = {}
             for host, settings in monitor_jobs.iteritems():
-                # Only get info when it is safe
-                if host in self._last_time:
-                    seconds_to_wait = settings['period'] - \
-                        (time.time() - self._last_time[host])
-                    if seconds_to_wait > 0:
+                if settings.get('events') and \
+                        settings['type'] != "PROMETHEUS":
+                    self._follow_events(host, settings, logger)
+                with self._lock:
+                    # Only get info when it is safe
+                    if host in self._last_time:
+                        seconds_to_wait = \
+                            self._poll_period(host, settings,
+                                              time.time()) - \
+                            (time.time() - self._last_time[host])
+                        if seconds_to_wait > 0:
+                            self._stats['hits'] += 1
+                            states.update(self._with_events(
+                                host,
+                                settings['names'],
+                                self._get_last_states(host,
+                                                      settings['names'])))
+                            continue
+                    if time.time() < self._throttled.get(host, 0):
+                        # out of budget, don't ask again until refilled
+                        self._stats['throttled'] += 1
+                        states.update(self._with_events(
+                            host,
+                            settings['names'],
+                            self._get_last_states(host, settings['names'])))
+                        continue
+                    wait = self._budget.take(settings.get('host') or host)
+                    if wait > 0:
+                        self._stats['throttled'] += 1
+                        self._throttled[host] = time.time() + wait
+                        shared = self._budget.shared_states(
+                            settings.get('host') or host)
+                        self._last_states.setdefault(host, {}).update(
+                            (name, shared[name])
+                            for name in settings['names'] if name in shared)
+                        states.update(self._with_events(
+                            host,
+                            settings['names'],
+                            self._get_last_states(host, settings['names'])))
                         continue
+                    self._stats['misses'] += 1
+                    self._last_time[host] = time.time()
 
                 logger.debug("Reading job status..")
-                self._last_time[host] = time.time()
+                pending[host] = run_async(self._get_states,
+                                          host,
+                                          settings,
+                                          logger)
 
-                if settings['type'] == "PROMETHEUS":  # external
-                    partial_states = self._get_prometheus(
-                        host,
-                        settings['config'],
-                        settings['names'])
-                else:  # internal
-                    wm = WorkloadManager.factory(settings['type'])
-                    if wm:
-                        partial_states = wm.get_states(
-                            settings['workdir'],
-                            settings['config'],
-                            settings['names'],
-                            logger
-                        )
-                    else:
-                        partial_states = self._no_states(
+            deadline = time.time() + MONITOR_TIMEOUT + MONITOR_GRACE
+            for host, result in pending.iteritems():
+                try:
+                    partial_states = result.get(max(0,
+                                                    deadline - time.time()))
+                except (SshTimeoutError,
+                        SshCircuitOpenError,
+                        TimeoutError,
+                        ssh_exception.SSHException,
+                        socket.error,
+                        requests.RequestException) as err:
+                    logger.warning("Keeping last states of host '" + host +
+                                   "': " + (str(err) or "timed out"))
+                    partial_states = None
+                except Exception:  # pylint: disable=W0703
+                    # a host must not stop the monitoring of the others
+                    logger.exception("Keeping last states of host '" +
+                                     host + "'")
+                    partial_states = None
+                else:
+                    with self._lock:
+                        self._last_states[host] = partial_states
+                        self._track(partial_states, time.time())
+                    self._budget.share(
+                        monitor_jobs[host].get('host') or host,
+                        partial_states)
+                with self._lock:
+                    if partial_states is None:
+                        partial_states = self._get_last_states(
                             host,
-                            settings['type'],
-                            settings['names'],
-                            logger)
-                states.update(partial_states)
+                            monitor_jobs[host]['names'])
+                    states.update(self._with_events(
+                        host,
+                        monitor_jobs[host]['names'],
+                        partial_states))
 
             return states
 
-        def _get_prometheus(self, host, config, names):
-            states = {}
-            url = config['url']
-            if len(names) == 1:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D%22')
-            else:
-                query = (url + '/api/v1/query?query=job_status'
-                         '%7Bjob%3D%22' + host +
-                         '%22%2Cname%3D~%22')
-            query += '|'.join(names) + '%22%7D'
+        def _get_states(self, host, settings, logger):
+            """ Gets the states of the jobs of a host, in MONITOR_TIMEOUT """
+            if settings['type'] == "PROMETHEUS":  # external
+                return self._get_prometheus(
+                    host,
+                    settings['config'],
+                    settings['names'])
+
+            # internal
+            wm = WorkloadManager.factory(settings['type'])
+            if wm:
+                with Deadline(MONITOR_TIMEOUT):
+                    return wm.get_states(
+                        settings['workdir'],
+                        settings['config'],
+                        settings['names'],
+                        logger,
+                        job_ids=settings.get('ids'),
+                        submitted=settings.get('submitted')
+                    )
+            return self._no_states(
+                host,
+                settings['type'],
+                settings['names'],
+                logger)
+
+        def invalidate(self, host):
+            """ Forgets the states of the jobs of a host, that is polled on
+            the next request. To be called when its jobs are sent or
+            cancelled. """
+            with self._lock:
+                self._stats['invalidations'] += 1
+                self._last_time.pop(host, None)
+                self._last_states.pop(host, None)
+
+        def stats(self):
+            """ Hits and misses of the states kept in memory, queries denied
+            by the budget, and times the states were invalidated """
+            with self._lock:
+                return dict(self._stats)
+
+        def _poll_period(self, host, settings, now):
+            """ Seconds between polls of a host, lock must be held.
 
-            payload = requests.get(query)
+            Every job asks for the monitor period, doubled on each poll its
+            state stays the same up to MAX_BACKOFF times for queued jobs, and
+            MAX_ACTIVE_BACKOFF times for the rest. Running jobs with a
+            'max_time' ask for half of the time left to reach it, so they are
+            polled on the monitor period again when they are about to
+            finish. The host is polled on the shortest period asked, that is
+            never below the monitor period, and jobs that are over ask for
+            none. Hosts with the events of all
+            their jobs followed are only polled to reconcile, every
+            EVENTS_RECONCILE periods. """
+            period = settings['period']
+            follower = self._followers.get(host)
+            if follower is not None and follower.alive:
+                events = follower.events()
+                if all(name in events for name in settings['names']):
+                    return period * EVENTS_RECONCILE
+            max_times = settings.get('max_times', {})
+            poll_period = period * MAX_BACKOFF
+            last_states = self._last_states.get(host, {})
+            for name in settings['names']:
+                if last_states.get(name) in _FINAL_STATES:
+                    continue
+                track = self._jobs.get(name)
+                if track is None or track.state in _TRANSIENT_STATES:
+                    return period
+                job_period = period * min(
+                    2 ** track.unchanged,
+                    MAX_BACKOFF if track.state in _QUEUED_STATES
+                    else MAX_ACTIVE_BACKOFF)
+                max_time = parse_max_time(max_times.get(name))
+                if track.state == 'RUNNING' and max_time is not None:
+                    job_period = min(job_period,
+                                     (track.since + max_time - now) / 2.0)
+                poll_period = min(poll_period, job_period)
+            return max(period, poll_period)
 
-            response = payload.json()
+        def _follow_events(self, host, settings, logger):
+            """ Follows the events log of the working directory of a
+            host """
+            with self._lock:
+                follower = self._followers.get(host)
+                if follower is not None and \
+                        follower.workdir == settings['workdir']:
+                    return
+                if follower is not None:
+                    follower.stop()
+                self._followers[host] = EventFollower(settings['config'],
+                                                      settings['workdir'],
+                                                      logger).start()
 
-            for item in response["data"]["result"]:
-                states[item["metric"]["name"]] = state_int_to_str(
-                    item["value"][1])
+        def forget(self, host):
+            """ Stops following the events of the jobs of a host, and drops
+            what is kept of them. To be called when the host is not
+            monitored anymore. """
+            with self._lock:
+                follower = self._followers.pop(host, None)
+                self._last_time.pop(host, None)
+                self._throttled.pop(host, None)
+                for name in self._last_states.pop(host, {}):
+                    self._jobs.pop(name, None)
+            if follower is not None:
+                follower.stop()
 
+        def stop_followers(self):
+            """ Stops following the events of the jobs """
+            with self._lock:
+                for follower in self._followers.values():
+                    follower.stop()
+                self._followers.clear()
+
+        def _with_events(self, host, names, states):
+            """ States of the jobs updated with their events received after
+            the last poll of the host, lock must be held """
+            follower = self._followers.get(host)
+            if follower is None:
+                return states
+            polled = self._last_time.get(host, 0)
+            events = follower.events()
+            states = dict(states)
+            for name in names:
+                if name in events and events[name][0] > polled:
+                    states[name] = events[name][1]
             return states
 
+        def _track(self, partial_states, now):
+            """ Follows the state changes of the jobs until they are over,
+            lock must be held """
+            for name, state in partial_states.iteritems():
+                track = self._jobs.get(name)
+                if state in _FINAL_STATES:
+                    self._jobs.pop(name, None)
+                elif track is None or track.state != state:
+                    self._jobs[name] = _JobTrack(state, now)
+                else:
+                    track.unchanged += 1
+
+        def _get_last_states(self, host, names):
+            """ Last known states of the jobs, lock must be held """
+            last_states = self._last_states.get(host, {})
+            return dict((name, last_states[name])
+                        for name in names if name in last_states)
+
+        def _get_prometheus(self, host, config, names):
+            return prometheus.get_client(config['url']).get_states(
+                host,
+                names,
+                MONITOR_TIMEOUT)
+
         def _no_states(self, host, mtype, names, logger):
             logger.error("Monitor of type " +
                          mtype +
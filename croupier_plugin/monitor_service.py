@@ -0,0 +1,289 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+monitor_service.py: Local service that monitors the jobs of all the
+executions of the manager, with one query per host and period
+'''
+
+
+import errno
+import json
+import logging
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+import time
+from SocketServer import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from threading import Lock
+
+from croupier_plugin.job_requester import (
+    MONITOR_GRACE,
+    MONITOR_TIMEOUT,
+    JobRequester)
+
+# Unix socket the service listens on, in a directory only the user of the
+# manager may access. Executions use it if it exists.
+MONITOR_SOCKET = os.path.join(tempfile.gettempdir(),
+                              'croupier_monitor_' + str(os.getuid()),
+                              'monitor.sock')
+
+# Monitors that read the states from files in the working directory
+_WORKDIR_MONITORS = ('BASH',)
+
+# Monitor periods the jobs of an execution are kept in the merged queries
+# after its last request
+SUBSCRIPTION_PERIODS = 10
+
+
+def get_requester(path=MONITOR_SOCKET):
+    """ Requester of the job states: the monitor service if it is running
+    as the user of the manager, the JobRequester of the execution if not """
+    if _private_socket(path):
+        return MonitorServiceClient(path)
+    return JobRequester()
+
+
+class MonitorService(ThreadingMixIn, UnixStreamServer):
+    """ Answers the job states requests of the executions. The jobs of every
+    execution on the same host and user are merged, so a single query gets
+    them all once per monitor period. """
+    daemon_threads = True
+
+    def __init__(self, path=MONITOR_SOCKET, logger=None):
+        # requests carry credentials, nobody else may reach the socket
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        if not _private_directory(directory):
+            raise EnvironmentError("Monitor service directory '" +
+                                   directory + "' must be a directory only "
+                                   "accessible by its owner, user " +
+                                   str(os.getuid()))
+        if os.path.exists(path):
+            os.remove(path)  # left by a service that is not running
+        umask = os.umask(0o177)
+        try:
+            UnixStreamServer.__init__(self, path, _MonitorHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        self.requester = JobRequester()
+        # key: {name: (expiration, time asked, settings)}
+        self._subscriptions = {}
+        self._lock = Lock()
+
+    def server_close(self):
+        UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def request(self, monitor_jobs):
+        """ States of the jobs, from a single merged query per host and user
+        and monitor period """
+        now = time.time()
+        merged = {}
+        with self._lock:
+            for host, settings in monitor_jobs.iteritems():
+                key = _subscription_key(host, settings)
+                jobs = self._subscriptions.setdefault(key, {})
+                if any(name not in jobs for name in settings['names']):
+                    # new jobs are not in the last merged query
+                    self.requester.invalidate(key)
+                expiration = now + settings['period'] * SUBSCRIPTION_PERIODS
+                for name in settings['names']:
+                    jobs[name] = (expiration, now, settings)
+
+            for key, jobs in self._subscriptions.items():
+                for name, (expiration, _, _) in jobs.items():
+                    if expiration < now:
+                        del jobs[name]
+                if not jobs:
+                    del self._subscriptions[key]
+                    self.requester.forget(key)
+                elif any(_subscription_key(host, settings) == key
+                         for host, settings in monitor_jobs.iteritems()):
+                    merged[key] = _merge(jobs, _subscription_host(key))
+
+        states = self.requester.request(merged, self.logger)
+        return dict((name, states[name])
+                    for settings in monitor_jobs.itervalues()
+                    for name in settings['names'] if name in states)
+
+    def invalidate(self, host):
+        """ Polls again the jobs of every user on the host """
+        with self._lock:
+            for key in self._subscriptions:
+                if _subscription_host(key) == host:
+                    self.requester.invalidate(key)
+
+
+class _MonitorHandler(StreamRequestHandler):
+    """ Newline delimited JSON requests and responses """
+
+    def handle(self):
+        for line in self.rfile:
+            message = json.loads(line)
+            response = {}
+            try:
+                if 'invalidate' in message:
+                    self.server.invalidate(message['invalidate'])
+                else:
+                    response['states'] = self.server.request(
+                        message['monitor_jobs'])
+            except Exception as err:  # pylint: disable=W0703
+                self.server.logger.exception("Monitor request failed")
+                response['error'] = str(err)
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+
+
+class MonitorServiceClient(object):
+    """ Requests the job states to the monitor service, with the interface
+    of JobRequester. Falls back to the JobRequester of the execution if the
+    service fails. """
+
+    def __init__(self, path=MONITOR_SOCKET):
+        self.path = path
+
+    def request(self, monitor_jobs, logger):
+        try:
+            return self._send({'monitor_jobs': monitor_jobs})['states']
+        except (EnvironmentError, ValueError, KeyError) as err:
+            logger.warning("Monitor service failed, monitoring the jobs "
+                           "locally: " + str(err))
+            return JobRequester().request(monitor_jobs, logger)
+
+    def invalidate(self, host):
+        try:
+            self._send({'invalidate': host})
+        except (EnvironmentError, ValueError, KeyError):
+            JobRequester().invalidate(host)
+
+    def stop_followers(self):
+        """ Events are followed by the service """
+        pass
+
+    def _send(self, message):
+        # the credentials are only sent to a service of the same user
+        if not _private_socket(self.path):
+            raise EnvironmentError("Monitor service socket '" + self.path +
+                                   "' is not private to user " +
+                                   str(os.getuid()))
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(MONITOR_TIMEOUT + 2 * MONITOR_GRACE)
+            sock.connect(self.path)
+            if hasattr(socket, 'SO_PEERCRED'):
+                _, uid, _ = struct.unpack('3i', sock.getsockopt(
+                    socket.SOL_SOCKET,
+                    socket.SO_PEERCRED,
+                    struct.calcsize('3i')))
+                if uid != os.getuid():
+                    raise EnvironmentError("Monitor service run by user " +
+                                           str(uid))
+            sock.sendall(json.dumps(message) + '\n')
+            response = json.loads(sock.makefile().readline())
+        finally:
+            sock.close()
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+
+def _private_directory(directory):
+    """ True if only the user of the manager may access the directory """
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and \
+        not info.st_mode & 0o077
+
+
+def _private_socket(path):
+    """ True if the socket is of the user of the manager, in a directory
+    only it may access """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid() and \
+        _private_directory(os.path.dirname(os.path.abspath(path)))
+
+
+def _subscription_key(host, settings):
+    """ Jobs of different users are not seen by the same queries, and jobs
+    monitored through files are only seen in their working directory """
+    key = host
+    config = settings['config']
+    if isinstance(config, dict) and config.get('user'):
+        key = config['user'] + '@' + key
+    if settings['type'] in _WORKDIR_MONITORS or settings.get('events'):
+        key += ':' + settings['workdir']
+    return key
+
+
+def _subscription_host(key):
+    """ HPC host of a subscription key """
+    return key.split(':', 1)[0].split('@')[-1]
+
+
+def _merge(jobs, host):
+    """ Settings of a merged query on the jobs of several executions on a
+    host. The working directory and credentials are the ones of the
+    execution that asked last, as the ones of finished executions may be
+    gone. """
+    _, _, latest = max(jobs.values(), key=lambda job: job[1])
+    settings = dict(latest, names=[], max_times={}, ids={}, submitted={},
+                    host=host)
+    for name, (_, _, job_settings) in sorted(jobs.items()):
+        settings['names'].append(name)
+        settings['period'] = min(settings['period'], job_settings['period'])
+        settings['events'] = settings.get('events') or \
+            job_settings.get('events')
+        settings['max_times'][name] = \
+            job_settings.get('max_times', {}).get(name)
+        if job_settings.get('ids', {}).get(name):
+            settings['ids'][name] = job_settings['ids'][name]
+        if job_settings.get('submitted', {}).get(name):
+            settings['submitted'][name] = job_settings['submitted'][name]
+    return settings
+
+
+def main(path=MONITOR_SOCKET):
+    """ Runs the monitor service until it is interrupted """
+    logging.basicConfig(level=logging.INFO)
+    service = MonitorService(path)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.server_close()
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
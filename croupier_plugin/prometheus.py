@@ -0,0 +1,154 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+prometheus.py: Client of the Prometheus servers that monitor the jobs
+'''
+
+
+import time
+from threading import Lock
+
+import requests
+
+from croupier_plugin.workload_managers.workload_manager import (
+    state_int_to_str)
+
+# Max job names matched by a single query
+QUERY_CHUNK_SIZE = 200
+
+# Seconds the states read from an endpoint are reused for all its hosts
+QUERY_CACHE_TTL = 5
+
+# Seconds the jobs asked for a host are still read with the other hosts
+ASKED_TTL = 600
+
+# Characters with a meaning in the regular expressions of Prometheus
+_REGEX_SPECIAL = '\\.+*?()|[]{}^$'
+
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_client(url):
+    """ Prometheus client of an endpoint, shared by all the hosts it
+    monitors """
+    with _clients_lock:
+        if url not in _clients:
+            _clients[url] = PrometheusClient(url)
+        return _clients[url]
+
+
+class PrometheusClient(object):
+    """ Queries the job states published in a Prometheus server, over a
+    persistent connection. The jobs recently asked for every host of the
+    server are read together, in queries of QUERY_CHUNK_SIZE names, and
+    the states are reused for QUERY_CACHE_TTL seconds. """
+
+    def __init__(self,
+                 url,
+                 chunk_size=QUERY_CHUNK_SIZE,
+                 cache_ttl=QUERY_CACHE_TTL):
+        self.url = url.rstrip('/')
+        self.chunk_size = chunk_size
+        self.cache_ttl = cache_ttl
+        self._session = requests.Session()
+        self._asked = {}  # host: {name: time asked}
+        self._read = {}  # host: (time read, names read, {name: state})
+        self._lock = Lock()
+
+    def get_states(self, host, names, timeout=None):
+        """
+        Get the states of the jobs of a host
+
+        @type host: string
+        @param host: host the jobs run in, that labels their metrics
+        @type names: list
+        @param names: names of the jobs
+        @type timeout: float
+        @param timeout: max seconds of each query
+        @rtype dict
+        @return a dictionary of job names and its states
+        """
+        with self._lock:
+            now = time.time()
+            self._asked.setdefault(host, {}).update(
+                (name, now) for name in names)
+            read = self._read.get(host)
+            if read is None or now - read[0] >= self.cache_ttl or \
+                    any(name not in read[1] for name in names):
+                self._read_asked(now, timeout)
+                read = self._read[host]
+            return dict((name, read[2][name])
+                        for name in names if name in read[2])
+
+    def _read_asked(self, now, timeout):
+        """ Reads the states of the jobs asked for every host, lock must be
+        held. Hosts asking at the same time wait for the same queries. """
+        for host, asked in self._asked.items():
+            for name, time_asked in asked.items():
+                if now - time_asked >= ASKED_TTL:
+                    del asked[name]
+            if not asked:
+                del self._asked[host]
+                self._read.pop(host, None)
+
+        hosts = '|'.join(_regex_escape(host) for host in sorted(self._asked))
+        names = sorted(set(name for asked in self._asked.itervalues()
+                           for name in asked))
+        states = dict((host, {}) for host in self._asked)
+        for start in range(0, len(names), self.chunk_size):
+            query = ('job_status{job=~"' + _quote(hosts) + '",name=~"' +
+                     _quote('|'.join(_regex_escape(name) for name in
+                                     names[start:start + self.chunk_size])) +
+                     '"}')
+            for item in self.query(query, timeout):
+                metric = item["metric"]
+                if metric.get("job") in states:
+                    states[metric["job"]][metric.get("name")] = \
+                        state_int_to_str(item["value"][1])
+
+        for host, asked in self._asked.iteritems():
+            self._read[host] = (now, set(asked), states[host])
+
+    def query(self, query, timeout=None):
+        """ Results of an instant query """
+        # POST so the queries are not limited by the length of the URL
+        response = self._session.post(self.url + '/api/v1/query',
+                                      data={'query': query},
+                                      timeout=timeout)
+        response.raise_for_status()
+        payload = response.json()
+        if payload.get("status") != "success":
+            raise requests.RequestException(
+                "Prometheus query failed: " + str(payload.get("error")))
+        return payload["data"]["result"]
+
+    def close(self):
+        """ Closes the connections to the server """
+        self._session.close()
+
+
+def _regex_escape(text):
+    return ''.join('\\' + char if char in _REGEX_SPECIAL else char
+                   for char in text)
+
+
+def _quote(text):
+    """ Quotes a PromQL string literal """
+    return text.replace('\\', '\\\\').replace('"', '\\"')
@@ -29,19 +29,31 @@ Todo:
 '''
 
 
+import atexit
+import codecs
+import hashlib
 import io
 import logging
+import random
 import select
 import socket
-import thread
+import sys
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+from threading import Condition, Lock
 
 from croupier_plugin.utilities import shlex_quote
-from paramiko import RSAKey, client, ssh_exception
-
+from paramiko import (DSSKey, ECDSAKey, RSAKey, Transport, client,
+                      ssh_exception)
 try:
-    import SocketServer
-except ImportError:
-    import socketserver as SocketServer
+    from paramiko import Ed25519Key
+except ImportError:  # paramiko < 2.2
+    Ed25519Key = None
 
 
 # # @TODO `posixpath` can be used for common pathname manipulations on
@@ -52,22 +64,76 @@ logging.getLogger("paramiko").setLevel(logging.WARNING)
 # Hack to avoid "Error reading SSH protocol banner" random issue
 logging.getLogger('paramiko.transport').addHandler(logging.NullHandler())
 
+# Seconds to establish a connection
+CONNECT_TIMEOUT = 30
+
+# Seconds between keepalives, and unanswered ones before the peer is dead
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_PROBES = 3
+
+# Not defined by the socket module of python 2
+_TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT',
+                            18 if sys.platform.startswith('linux') else None)
+
+# Deadlines of the remote calls of each thread
+_deadlines = threading.local()
+
+# Max remote calls running at once in the background, over every host
+ASYNC_WORKERS = 32
+_executor = None
+_executor_lock = Lock()
+
+# Synthetic output of the transport benchmark, alike to scheduler dumps
+BENCHMARK_COMMAND = ("yes '1234567|croupier_job_name_0001|RUNNING|00:12:34|"
+                     "2019-01-01T00:00:00' | head -c {}")
+BENCHMARK_OUTPUT_SIZE = 8388608
+BENCHMARK_WINDOW_SIZES = (2097152, 8388608)
+
+# Max bytes read from a channel at once
+READ_CHUNK_SIZE = 32768
+
+# Max bytes of the error output kept by streamed commands
+STDERR_BUFFER_SIZE = 65536
+
+# Bytes at the end of the output where the marker of a command is looked for
+MARKER_TAIL_SIZE = 128
+
+# Seconds to wait for the login environment to be captured
+LOGIN_ENV_TIMEOUT = 60
+
+# Login shell variables that are not replayed
+_LOGIN_ENV_IGNORED = ('_', 'SHLVL', 'PWD', 'OLDPWD')
+
+# Max private keys kept parsed in memory
+PRIVATE_KEY_CACHE_SIZE = 32
+
+_PRIVATE_KEY_CLASSES = [key_class for key_class in (RSAKey,
+                                                    Ed25519Key,
+                                                    ECDSAKey,
+                                                    DSSKey)
+                        if key_class is not None]
+_private_keys = OrderedDict()
+_private_keys_lock = Lock()
+
+# Bytes relayed at once by SshForward, and seconds between close checks
+RELAY_BUFFER_SIZE = 262144
+RELAY_POLL_PERIOD = 1
+
 
 class SshClient(object):
     """Represents a ssh client"""
     _client = None
 
     def __init__(self, credentials):
-        # Build a tunnel if necessary
+        # Use the jump host session if necessary, the traffic to the host
+        # goes through a channel of its transport
         self._tunnel = None
+        self.credentials = credentials
         self._host = credentials['host']
         if 'user' in credentials:
             self._user = credentials['user']
         self._port = int(credentials['port']) if 'port' in credentials else 22
-        if 'tunnel' in credentials and credentials['tunnel']:
-            self._tunnel = SshForward(credentials)
-            self._host = "localhost"
-            self._port = self._tunnel.port()
+        self._tunnel_credentials = credentials.get('tunnel')
 
         self._client = client.SSHClient()
         self._client.set_missing_host_key_policy(client.AutoAddPolicy())
@@ -75,20 +141,13 @@ class SshClient(object):
         # Build the private key if provided
         private_key = None
         if 'private_key' in credentials and credentials['private_key']:
-            key_data = credentials['private_key']
-            if not isinstance(key_data, unicode):
-                key_data = unicode(key_data, "utf-8")
-            key_file = io.StringIO()
-            key_file.write(key_data)
-            key_file.seek(0)
             if 'private_key_password' in credentials and \
                     credentials['private_key_password'] != "":
                 private_key_password = credentials['private_key_password']
             else:
                 private_key_password = None
-            private_key = RSAKey.from_private_key(
-                key_file,
-                password=private_key_password)
+            private_key = load_private_key(credentials['private_key'],
+                                           private_key_password)
 
         # This switch allows to execute commands in a login shell.
         # By default commands are executed on the remote host.
@@ -100,29 +159,103 @@ class SshClient(object):
         self._login_shell = False
         if 'login_shell' in credentials:
             self._login_shell = credentials['login_shell']
+        # If set, the login environment is captured once and replayed
+        # for this many seconds, instead of starting a login shell per
+        # command
+        self._login_env_ttl = int(credentials.get('login_env_ttl', 0))
+        self._login_env = None
+        self._login_env_time = None
+
+        # If set, shell commands waiting for their result are run in a
+        # long-lived remote shell instead of a new channel each
+        self._persistent_shell = credentials.get('persistent_shell', False)
+        self._shell = None
+
+        self._keepalive = int(credentials.get('keepalive_interval',
+                                              KEEPALIVE_INTERVAL))
+
+        # Transport tuning, for bulk outputs over slow links
+        tuning = {}
+        if credentials.get('compress'):
+            tuning['compress'] = True
+        disabled_algorithms = {}
+        for algorithms in ('ciphers', 'macs'):
+            if credentials.get(algorithms):
+                # restricts the algorithms to the given ones
+                disabled_algorithms[algorithms] = [
+                    name for name in getattr(Transport,
+                                             '_preferred_' + algorithms)
+                    if name not in credentials[algorithms]]
+        if disabled_algorithms:
+            tuning['disabled_algorithms'] = disabled_algorithms
 
-        retries = 5
         passwd = credentials['password'] if 'password' in credentials else None
-        while True:
-            try:
-                self._client.connect(
+        connect_start = time.time()
+        try:
+            if self._tunnel_credentials:
+                self._tunnel = SshJumpHosts().acquire(
+                    self._tunnel_credentials)
+            # the governor retries transient failures, as the "Error reading
+            # SSH protocol banner" of a host busy with other handshakes
+            SshGovernor().connect(
+                self._host + ":" + str(self._port),
+                lambda: self._client.connect(
                     self._host,
                     port=self._port,
                     username=credentials['user'],
                     pkey=private_key,
                     password=passwd,
-                    look_for_keys=False
-                )
-            except ssh_exception.SSHException as err:
-                if retries > 0 and \
-                        str(err) == "Error reading SSH protocol banner":
-                    retries -= 1
-                    logging.getLogger("paramiko").\
-                        warning("Retrying SSH connection: " + str(err))
-                    continue
-                else:
-                    raise err
-            break
+                    look_for_keys=False,
+                    sock=self._open_socket(),
+                    timeout=_connect_timeout(),
+                    banner_timeout=_connect_timeout(),
+                    auth_timeout=_connect_timeout(),
+                    **tuning))
+            transport = self._client.get_transport()
+            # keepalives also make a dead peer noticed
+            transport.set_keepalive(self._keepalive)
+            # applied to the channels opened from now on
+            if credentials.get('window_size'):
+                transport.default_window_size = \
+                    int(credentials['window_size'])
+            if credentials.get('max_packet_size'):
+                transport.default_max_packet_size = \
+                    int(credentials['max_packet_size'])
+        except Exception:
+            self.close_connection()
+            raise
+        self.connect_time = time.time() - connect_start
+        self.last_timings = {}
+
+    def _open_socket(self):
+        """Opens the connection to the host, through a direct-tcpip channel
+        of the tunnel if any, or a TCP socket that probes the peer"""
+        if self._tunnel is not None:
+            return self._tunnel.get_transport().open_channel(
+                "direct-tcpip",
+                (self._host, self._port),
+                ("127.0.0.1", 0),
+                timeout=_connect_timeout())
+
+        sock = socket.create_connection((self._host, self._port),
+                                        _connect_timeout())
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP,
+                            socket.TCP_KEEPIDLE,
+                            self._keepalive)
+            sock.setsockopt(socket.IPPROTO_TCP,
+                            socket.TCP_KEEPINTVL,
+                            self._keepalive)
+            sock.setsockopt(socket.IPPROTO_TCP,
+                            socket.TCP_KEEPCNT,
+                            KEEPALIVE_PROBES)
+        if _TCP_USER_TIMEOUT is not None:
+            # milliseconds that sent data can go unacknowledged
+            sock.setsockopt(socket.IPPROTO_TCP,
+                            _TCP_USER_TIMEOUT,
+                            self._keepalive * KEEPALIVE_PROBES * 1000)
+        return sock
 
     def get_transport(self):
         """Gets the transport object of the client (paramiko)"""
@@ -132,12 +265,29 @@ class SshClient(object):
         """Check if connection is open"""
         return self._client is not None
 
+    def is_alive(self):
+        """Check that the underlying transport still reaches the host"""
+        if self._client is None:
+            return False
+        transport = self._client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (ssh_exception.SSHException, socket.error, EOFError):
+            return False
+        return True
+
     def close_connection(self):
         """Closes opened connection"""
+        if self._shell is not None:
+            self._shell.close()
+            self._shell = None
         if self._client is not None:
             self._client.close()
         if self._tunnel is not None:
-            self._tunnel.close()
+            SshJumpHosts().release(self._tunnel_credentials)
+            self._tunnel = None
 
     def execute_shell_command(self,
                               cmd,
@@ -155,117 +305,352 @@ class SshClient(object):
         if detach:
             wait_result = False
             cmd = "nohup " + cmd + " &"
+        elif wait_result and self._persistent_shell:
+            # a subshell keeps workdir and env from leaking to the session
+            return self.run_in_shell(
+                "(" + self._build_shell_call(cmd, workdir, env) + "\n)")
+
+        return self.send_command(self._build_shell_call(cmd, workdir, env),
+                                 wait_result=wait_result)
+
+    def execute_shell_batch(self,
+                            cmds,
+                            workdir=None,
+                            env=None,
+                            fail_fast=False):
+        """ Execute several commands remotely like execute_shell_command,
+        one after the other in a single round trip. See run_batch. """
+        return self.run_batch([self._build_shell_call(cmd, workdir, env)
+                               for cmd in cmds],
+                              fail_fast=fail_fast)
+
+    def upload(self,
+               content,
+               path,
+               mode=0o644,
+               workdir=None,
+               exec_timeout=3000):
+        """ Writes the content, a string or a file-like object, to the remote
+        path (relative to workdir if set) in a single channel.
+
+        The content is streamed to a temporary file next to the path, that
+        is given the mode and then renamed over the path, so the file is
+        never seen half written and retries do not duplicate it. Returns
+        True if the file was written. """
+        if self._client is None:
+            return False
 
+        temp_path = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        call = ("cat > {0} && chmod {1:o} {0} && mv -f {0} {2} || "
+                "{{ rm -f {0}; exit 1; }}").format(shlex_quote(temp_path),
+                                                   mode,
+                                                   shlex_quote(path))
+        wrapped = self._wrap_command(self._build_shell_call(call,
+                                                            workdir,
+                                                            None))
+        channel = self._client.get_transport().open_session()
+        try:
+            channel.exec_command(wrapped)
+            if hasattr(content, 'read'):
+                chunk = content.read(READ_CHUNK_SIZE)
+                while chunk:
+                    channel.sendall(_encode(chunk))
+                    chunk = content.read(READ_CHUNK_SIZE)
+            else:
+                channel.sendall(_encode(content))
+            channel.shutdown_write()
+
+            reader = _ChannelReader(channel, exec_timeout)
+            while reader.wait():
+                reader.read()
+        finally:
+            channel.close()
+        self._log_timings("upload of " + path, reader)
+        return reader.finished and channel.recv_exit_status() == 0
+
+    def stream_shell_command(self,
+                             cmd,
+                             workdir=None,
+                             env=None,
+                             stderr_limit=STDERR_BUFFER_SIZE):
+        """ Execute the command remotely like execute_shell_command, but
+        returns a CommandStream to read its output lines as they arrive """
+        return self.stream_command(self._build_shell_call(cmd, workdir, env),
+                                   stderr_limit=stderr_limit)
+
+    def _build_shell_call(self, cmd, workdir, env):
         call = ""
         if env is not None:
             for key, value in env.iteritems():
                 call += "export " + key + "=" + value + " && "
 
-        if not workdir:
-            call += cmd
-            return self.send_command(call,
-                                     wait_result=wait_result)
-        else:
+        if workdir:
             # TODO: set scale variables as well
             call += "export CURRENT_WORKDIR=" + workdir + " && "
             call += "cd " + workdir + " && "
-            call += cmd
-            return self.send_command(call,
-                                     wait_result=wait_result)
+        return call + cmd
 
     def send_command(self,
                      command,
                      exec_timeout=3000,
-                     read_chunk_timeout=500,
                      wait_result=False):
-        """Sends a command and returns stdout, stderr and exitcode"""
+        """Sends a command and returns stdout and exitcode
+
+        Raises SshTimeoutError if the command does not finish in
+        exec_timeout seconds, or before the Deadline of the thread."""
 
         # Check if connection is made previously
         if self._client is not None:
 
-            if self._login_shell:
-                cmd = "bash -l -c {}".format(shlex_quote(command))
-            else:
-                cmd = command
             # there is one channel per command
-            stdin, stdout, stderr = self._client.exec_command(
-                cmd,
-                timeout=exec_timeout)
+            wrapped = self._wrap_command(command)
+            channel = self._client.get_transport().open_session()
+            channel.exec_command(wrapped)
 
-            if wait_result:
-                # get the shared channel for stdout/stderr/stdin
-                channel = stdout.channel
+            if not wait_result:
+                return True
 
-                # we do not need stdin
-                stdin.close()
-                # indicate that we're not going to write to that channel
-                channel.shutdown_write()
+            # indicate that we're not going to write to that channel
+            channel.shutdown_write()
 
-                # read stdout/stderr in order to prevent read block hangs
+            try:
+                reader = _ChannelReader(channel, exec_timeout)
                 stdout_chunks = []
-                stdout_chunks.append(stdout.channel.recv(
-                    len(stdout.channel.in_buffer)))
-                # chunked read to prevent stalls
-                while (not channel.closed
-                       or channel.recv_ready()
-                       or channel.recv_stderr_ready()):
-                    # Stop if channel was closed prematurely,
-                    # and there is no data in the buffers.
-                    got_chunk = False
-                    readq, _, _ = select.select([stdout.channel],
-                                                [],
-                                                [],
-                                                read_chunk_timeout)
-                    for c in readq:
-                        if c.recv_ready():
-                            stdout_chunks.append(stdout.channel.recv(
-                                len(c.in_buffer)))
-                            got_chunk = True
-                        if c.recv_stderr_ready():
-                            # make sure to read stderr to prevent stall
-                            stderr.channel.recv_stderr(len(c.in_stderr_buffer))
-                            got_chunk = True
-                    '''
-                    1) make sure that there are at least 2 cycles with no data
-                        in the input buffers in order to not exit too early
-                        (i.e. cat on a >200k file).
-                    2) if no data arrived in the last loop, check if we already
-                        received the exit code
-                    3) check if input buffers are empty
-                    4) exit the loop
-                    '''
-                    if (not got_chunk
-                            and stdout.channel.exit_status_ready()
-                            and not stderr.channel.recv_stderr_ready()
-                            and not stdout.channel.recv_ready()):
-                        # Indicate that we're not going to read from
-                        # this channel anymore
-                        stdout.channel.shutdown_read()
-                        # close the channel
-                        stdout.channel.close()
-                        # Remote side is finished & our bufferes are empty
-                        break
-
-            # close all the pseudofiles
-            stdout.close()
-            stderr.close()
+                while reader.wait():
+                    stdout, _ = reader.read()  # stderr read to prevent stalls
+                    stdout_chunks.append(stdout)
+            finally:
+                channel.close()
+            self._log_timings(command, reader)
 
-            if wait_result:
-                # exit code is always ready at this point
-                exit_code = stdout.channel.recv_exit_status()
-                if exit_code == 0:
-                    output = ''.join(stdout_chunks)
-                else:
-                    output = ''.join(stdout_chunks)  # TODO stderr
-                return (output, exit_code)
-            else:
-                return True
+            exit_code = channel.recv_exit_status()
+            if exit_code == 127 and self._login_env:
+                # command not found, the environment may have changed
+                self.invalidate_login_env()
+            output = ''.join(stdout_chunks)  # TODO stderr
+            return (output, exit_code)
         else:
             if wait_result:
                 return (None, None)
             else:
                 return False
 
+    def run_in_shell(self,
+                     command,
+                     exec_timeout=3000):
+        """Runs a command in the long-lived shell of the connection, that
+        keeps the working directory and environment between commands.
+        Returns stdout and exitcode"""
+        if self._client is None:
+            return (None, None)
+
+        shell = self._get_shell()
+        try:
+            output, _, exit_code = shell.run(command, exec_timeout)
+        finally:
+            self.last_timings = dict(shell.last_timings,
+                                     connect=self.connect_time)
+            if shell.closed:
+                # the shell is restarted on the next command
+                self._shell = None
+        return (output, exit_code)
+
+    def run_batch(self,
+                  commands,
+                  fail_fast=False,
+                  exec_timeout=3000):
+        """Runs several commands one after the other as a single remote
+        script, in one round trip
+
+        Returns a list with a (stdout, stderr, exitcode) tuple per command,
+        in the same order. If fail_fast is set, the commands after the first
+        one failing are not run. A command exiting the script gets its exit
+        code, and the ones after it are not run. Commands not run get None
+        as exitcode."""
+        if self._client is None:
+            return [(None, None, None) for _ in commands]
+        if not commands:
+            return []
+
+        markers = [uuid.uuid4().hex for _ in commands]
+        script = ''.join(_marked_command(command, marker, fail_fast)
+                         for command, marker in zip(commands, markers))
+        if self._persistent_shell:
+            # the subshell keeps fail_fast from exiting the session
+            shell = self._get_shell()
+            stdout, stderr, script_exit = shell.run("(\n" + script + ")",
+                                                    exec_timeout)
+            if script_exit == -1:
+                script_exit = None
+            self.last_timings = dict(shell.last_timings,
+                                     connect=self.connect_time)
+        else:
+            wrapped = self._wrap_command(script)
+            channel = self._client.get_transport().open_session()
+            channel.exec_command(wrapped)
+            channel.shutdown_write()
+            try:
+                reader = _ChannelReader(channel, exec_timeout)
+                stdout_chunks = []
+                stderr_chunks = []
+                while reader.wait():
+                    stdout, stderr = reader.read()
+                    stdout_chunks.append(stdout)
+                    stderr_chunks.append(stderr)
+            finally:
+                channel.close()
+            self._log_timings("batch of " + str(len(commands)), reader)
+            script_exit = channel.recv_exit_status()
+            stdout = b''.join(stdout_chunks)
+            stderr = b''.join(stderr_chunks)
+
+        results = []
+        for marker in markers:
+            stdout_parts = _split_marked(stdout, marker)
+            if stdout_parts is None:
+                if fail_fast and results and results[-1][2] != 0:
+                    script_exit = None  # not run
+                # the rest of the output belongs to the command that exited
+                # the script
+                results.append((stdout, stderr, script_exit))
+                stdout = stderr = b''
+                script_exit = None
+                continue
+            command_stdout, exit_code, stdout = stdout_parts
+            stderr_parts = _split_marked(stderr, marker)
+            if stderr_parts is None:
+                command_stderr, stderr = stderr, b''
+            else:
+                command_stderr, _, stderr = stderr_parts
+            results.append((command_stdout, command_stderr, int(exit_code)))
+        return results
+
+    def _get_shell(self):
+        """Gets the shell session of the connection, starting it if needed"""
+        if self._shell is None or self._shell.closed:
+            self._shell = ShellSession(self._client.get_transport())
+        return self._shell
+
+    def stream_command(self,
+                       command,
+                       exec_timeout=3000,
+                       stderr_limit=STDERR_BUFFER_SIZE):
+        """Sends a command and returns a CommandStream over its output"""
+        wrapped = self._wrap_command(command)
+        channel = self._client.get_transport().open_session()
+        try:
+            channel.exec_command(wrapped)
+            channel.shutdown_write()
+            return CommandStream(channel, exec_timeout, stderr_limit)
+        except BaseException:
+            channel.close()
+            raise
+
+    def run_many(self,
+                 commands,
+                 exec_timeout=3000):
+        """Runs several commands concurrently, one channel per command
+
+        All the channels share the same transport, so independent commands
+        against the host overlap instead of queueing. Returns a list with
+        a (stdout, stderr, exitcode) tuple per command, in the same order.
+        Raises SshTimeoutError if any is not finished after exec_timeout."""
+        if self._client is None:
+            return [(None, None, None) for _ in commands]
+
+        transport = self._client.get_transport()
+        channels = []
+        try:
+            for command in map(self._wrap_command, commands):
+                channel = transport.open_session()
+                channel.exec_command(command)
+                channel.shutdown_write()
+                channels.append(channel)
+
+            readers = [_ChannelReader(opened, exec_timeout)
+                       for opened in channels]
+            stdout_chunks = dict((reader, []) for reader in readers)
+            stderr_chunks = dict((reader, []) for reader in readers)
+            exit_codes = {}
+            pending = list(readers)
+            while pending:
+                # once all are finished, the last output and exit statuses
+                # are still to be read, the status may come after the eof
+                _ChannelReader.wait_any(pending)
+                for reader in list(pending):
+                    stdout, stderr = reader.read()
+                    while stdout or stderr:
+                        stdout_chunks[reader].append(stdout)
+                        stderr_chunks[reader].append(stderr)
+                        stdout, stderr = reader.read()
+                    if reader.finished:
+                        exit_codes[reader] = \
+                            reader.channel.recv_exit_status()
+                        pending.remove(reader)
+        finally:
+            for channel in channels:
+                channel.close()
+
+        return [(''.join(stdout_chunks[reader]),
+                 ''.join(stderr_chunks[reader]),
+                 exit_codes.get(reader))
+                for reader in readers]
+
+    def _log_timings(self, command, reader):
+        self.last_timings = dict(reader.timings(), connect=self.connect_time)
+        logging.getLogger(__name__).debug("'%s' timings (seconds): %s",
+                                          command,
+                                          self.last_timings)
+
+    def _wrap_command(self, command):
+        """Adapts the command to the configured remote shell"""
+        if self._login_shell:
+            login_env = self._get_login_env()
+            if login_env:
+                return "{} bash -c {}".format(login_env, shlex_quote(command))
+            return "bash -l -c {}".format(shlex_quote(command))
+        return command
+
+    def invalidate_login_env(self):
+        """Forgets the login environment snapshot, if any"""
+        self._login_env = None
+        self._login_env_time = None
+
+    def _get_login_env(self):
+        """Gets the `env -i ...` prefix that replays the login environment,
+        capturing it if there is no fresh snapshot"""
+        if self._login_env_ttl <= 0:
+            return None
+        if self._login_env_time is not None and \
+                time.time() - self._login_env_time < self._login_env_ttl:
+            return self._login_env
+
+        self._login_env_time = time.time()
+        self._login_env = None
+        channel = self._client.get_transport().open_session()
+        try:
+            channel.exec_command("bash -l -c 'env -0'")
+            channel.shutdown_write()
+            reader = _ChannelReader(channel, LOGIN_ENV_TIMEOUT)
+            stdout_chunks = []
+            while reader.wait():
+                stdout, _ = reader.read()
+                stdout_chunks.append(stdout)
+        finally:
+            channel.close()
+        if channel.recv_exit_status() != 0:
+            logging.getLogger("paramiko").warning(
+                "Could not capture the login environment, "
+                "using a login shell per command")
+            return None
+
+        variables = [variable for variable in ''.join(stdout_chunks)
+                     .split('\0')
+                     if '=' in variable and variable.split('=', 1)[0]
+                     not in _LOGIN_ENV_IGNORED]
+        self._login_env = "env -i " + ' '.join(map(shlex_quote, variables))
+        return self._login_env
+
     @staticmethod
     def check_ssh_client(ssh_client,
                          logger):
@@ -275,99 +660,960 @@ class SshClient(object):
         return True
 
 
-class SshForward(object):
-    """Represents a ssh port forwarding"""
+class ShellSession(object):
+    """ Long-lived remote shell, driven through invoke_shell, that runs
+    commands one after the other saving the channel setup and the shell
+    startup of each one.
 
-    def __init__(self, credentials):
-        self._client = SshClient(credentials['tunnel'])
-        self._remote_port = \
-            int(credentials['port']) if 'port' in credentials else 22
+    The output and exit code of every command are delimited with a marker
+    unique to the command, in both stdout and stderr. As the shell is not
+    interactive there is no prompt nor echo to strip. The session is closed
+    if a command exits the shell, does not finish in time or is cancelled.
+    """
 
-        class SubHander(Handler):
-            chain_host = credentials['host']
-            chain_port = self._remote_port
-            ssh_transport = self._client.get_transport()
+    def __init__(self, transport):
+        self.last_timings = {}
+        self._lock = Lock()
+        self._channel = transport.open_session()
+        self._channel.invoke_shell()
+        # drops whatever the profile scripts write
+        self.run('true')
 
-        self._server = ForwardServer(("", 0), SubHander)
-        self._port = self._server.server_address[1]
+    @property
+    def closed(self):
+        """ True if the session can not run more commands """
+        return self._channel.closed or self._channel.eof_received
 
-        thread.start_new_thread(self._server.serve_forever, ())
+    def close(self):
+        """ Ends the shell, closing its channel """
+        self._channel.close()
 
-    def port(self):
-        return self._port
+    def run(self, command, exec_timeout=3000):
+        """ Runs the command in the shell and returns its stdout, stderr
+        and exit code, which is -1 if the shell is gone """
+        marker = uuid.uuid4().hex
+        with self._lock:
+            if self.closed:
+                return (None, None, None)
+            self._channel.sendall(_marked_command(command, marker))
+
+            # the marker lines are the last output of the command
+            stdout_chunks = []
+            stderr_chunks = []
+            stdout_tail = b''
+            stderr_tail = b''
+            try:
+                reader = _ChannelReader(self._channel, exec_timeout)
+                while _split_marked(stdout_tail, marker) is None or \
+                        _split_marked(stderr_tail, marker) is None:
+                    if not reader.wait():
+                        break
+                    stdout, stderr = reader.read()
+                    stdout_chunks.append(stdout)
+                    stderr_chunks.append(stderr)
+                    stdout_tail = (stdout_tail + stdout)[-MARKER_TAIL_SIZE:]
+                    stderr_tail = (stderr_tail + stderr)[-MARKER_TAIL_SIZE:]
+            except (SshTimeoutError, SshCancelledError):
+                # the shell is in an unknown state
+                self.close()
+                raise
+            reader.exited = time.time()
+            self.last_timings = reader.timings()
+
+            stdout = b''.join(stdout_chunks)
+            stderr = b''.join(stderr_chunks)
+            stdout_parts = _split_marked(stdout, marker)
+            stderr_parts = _split_marked(stderr, marker)
+            if stdout_parts is not None and stderr_parts is not None:
+                return (stdout_parts[0], stderr_parts[0], int(stdout_parts[1]))
+
+            # the shell is gone
+            if stdout_parts is not None:
+                stdout, exit_code = stdout_parts[0], int(stdout_parts[1])
+            elif self._channel.exit_status_ready():
+                exit_code = self._channel.recv_exit_status()
+            else:
+                exit_code = -1
+            self.close()
+            return (stdout, stderr, exit_code)
+
+
+def _encode(content):
+    """ Bytes of the content, encoded as utf-8 if unicode """
+    if isinstance(content, unicode):
+        return content.encode('utf-8')
+    return content
+
+
+def _marked_command(command, marker, fail_fast=False):
+    """ Shell lines that run the command and then write the marker, with its
+    exit code, to stdout and the marker to stderr. If fail_fast is set the
+    shell exits if the command fails. """
+    lines = ("eval {0} < /dev/null\n"
+             "__croupier_status=$?\n"
+             "printf '\\n%s %d\\n' {1} \"$__croupier_status\"\n"
+             "printf '\\n%s\\n' {1} >&2\n")
+    if fail_fast:
+        lines += ('[ "$__croupier_status" -eq 0 ] || '
+                  'exit "$__croupier_status"\n')
+    return lines.format(shlex_quote(command), marker)
+
+
+def _split_marked(data, marker):
+    """ Splits the output of a _marked_command at the marker line. Returns
+    the output before the marker, the rest of the marker line and the output
+    after it, or None if the marker line is not complete """
+    start = data.find(b'\n' + marker)
+    if start < 0:
+        return None
+    end = data.find(b'\n', start + 1)
+    if end < 0:
+        return None
+    return (data[:start],
+            data[start + 1 + len(marker):end].strip(),
+            data[end + 1:])
+
+
+class CommandStream(object):
+    """ Iterates over the decoded output lines of a remote command as they
+    arrive, without keeping the whole output in memory.
+
+    Only the last stderr_limit bytes of the error output are kept. Once the
+    iteration is over, exit_code holds the exit code of the command. The
+    iteration raises SshTimeoutError if the command does not finish in
+    exec_timeout seconds. """
+
+    def __init__(self, channel, exec_timeout, stderr_limit):
+        self.exit_code = None
+        self._channel = channel
+        self._reader = _ChannelReader(channel, exec_timeout)
+        self._stderr_limit = stderr_limit
+        self._stderr = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def stderr(self):
+        """ Tail of the error output of the command """
+        return bytes(self._stderr)
 
     def close(self):
-        self._server.shutdown()
+        """ Stops reading, closing the channel of the command """
+        self._channel.close()
+
+    def timings(self):
+        """ Seconds to the first byte and to the exit of the command """
+        return self._reader.timings()
+
+    def __iter__(self):
+        reader = self._reader
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        pending = u''
+        try:
+            while reader.wait():
+                stdout, stderr = reader.read()
+                if stderr:
+                    self._stderr += stderr
+                    del self._stderr[:-self._stderr_limit]
+                if stdout:
+                    pending += decoder.decode(stdout)
+                    lines = pending.split(u'\n')
+                    pending = lines.pop()
+                    for line in lines:
+                        yield line + u'\n'
+            pending += decoder.decode(b'', final=True)
+            if pending:
+                yield pending
+            self.exit_code = self._channel.recv_exit_status()
+        finally:
+            self.close()
+
+
+class _ChannelReader(object):
+    """ Reads the output of a command channel as data and exit events come,
+    in bounded chunks, keeping track of the command timings """
+
+    def __init__(self, channel, exec_timeout):
+        self.channel = channel
+        self.started = time.time()
+        self.deadline = self.started + _remaining(exec_timeout)
+        self.deadlines = list(_deadline_stack())
+        for deadline in self.deadlines:
+            deadline.track(self)
+        self.first_byte = None
+        self.exited = None
+
+    @property
+    def finished(self):
+        """ True when the command exited and all its output was read, or
+        the channel is closed """
+        channel = self.channel
+        if channel.recv_ready() or channel.recv_stderr_ready():
+            return False
+        if channel.closed or \
+                (channel.eof_received and channel.exit_status_ready()):
+            if self.exited is None:
+                self.exited = time.time()
+            return True
+        return False
+
+    def wait(self):
+        """ Blocks until there is output to read or the command finishes.
+        Returns False once finished, see wait_any. """
+        return _ChannelReader.wait_any([self])
+
+    @staticmethod
+    def wait_any(readers):
+        """ Blocks until any of the readers has output to read or finishes.
+        Returns False if all finished. Raises SshTimeoutError once the
+        deadline is reached, and SshCancelledError if cancelled. """
+        for reader in readers:
+            for deadline in reader.deadlines:
+                if deadline.cancelled:
+                    raise SshCancelledError("Remote command cancelled")
+        readers = [reader for reader in readers if not reader.finished]
+        if not readers:
+            return False
+        remaining = min(reader.deadline for reader in readers) - time.time()
+        if remaining <= 0:
+            raise SshTimeoutError(
+                "Remote command not finished in %.1f seconds" %
+                (time.time() - readers[0].started))
+        for reader in readers:
+            if reader.channel.recv_ready() or \
+                    reader.channel.recv_stderr_ready():
+                return True
+        # data, eof and close events wake up the channel pipe, while the
+        # exit status has its own event, usually set right after the eof
+        running = [reader.channel for reader in readers
+                   if not reader.channel.eof_received and
+                   not reader.channel.closed]
+        if running:
+            select.select(running, [], [], remaining)
+        else:
+            readers[0].channel.status_event.wait(remaining)
+        return True
+
+    def read(self):
+        """ Reads the available stdout and stderr, up to READ_CHUNK_SIZE
+        bytes each """
+        stdout = b''
+        stderr = b''
+        if self.channel.recv_ready():
+            stdout = self.channel.recv(READ_CHUNK_SIZE)
+        if self.channel.recv_stderr_ready():
+            stderr = self.channel.recv_stderr(READ_CHUNK_SIZE)
+        if (stdout or stderr) and self.first_byte is None:
+            self.first_byte = time.time()
+        return stdout, stderr
 
+    def timings(self):
+        """ Seconds to the first byte and to the exit of the command """
+        return {
+            'first_byte': (None if self.first_byte is None
+                           else self.first_byte - self.started),
+            'exit': None if self.exited is None else self.exited - self.started
+        }
 
-# Following code taken from paramiko forward demo in github
-# https://github.com/paramiko/paramiko/blob/master/demos/forward.py
 
-class ForwardServer(SocketServer.ThreadingTCPServer):
-    daemon_threads = True
-    allow_reuse_address = True
+class AsyncSshClient(object):
+    """ Runs the commands of SshClient in the background, on the shared
+    bounded executor, through connections of the SshPool. Every call returns
+    an AsyncResult, whose get() gives the result of the command or raises
+    its error, so the commands to many hosts are waited for at once. """
 
+    def __init__(self, credentials):
+        self._credentials = credentials
+
+    def call(self, method, *args, **kwargs):
+        """ Calls a method of a pooled SshClient in the background """
+        return run_async(_call_pooled,
+                         self._credentials,
+                         method,
+                         args,
+                         kwargs)
+
+    def send_command(self, *args, **kwargs):
+        """ See SshClient.send_command """
+        return self.call('send_command', *args, **kwargs)
+
+    def execute_shell_command(self, *args, **kwargs):
+        """ See SshClient.execute_shell_command """
+        return self.call('execute_shell_command', *args, **kwargs)
+
+    def execute_shell_batch(self, *args, **kwargs):
+        """ See SshClient.execute_shell_batch """
+        return self.call('execute_shell_batch', *args, **kwargs)
+
+    def upload(self, *args, **kwargs):
+        """ See SshClient.upload """
+        return self.call('upload', *args, **kwargs)
+
+
+def _call_pooled(credentials, method, args, kwargs):
+    with SshPool().connection(credentials) as client:
+        return getattr(client, method)(*args, **kwargs)
+
+
+def run_async(function, *args, **kwargs):
+    """ Calls the function in the background, on the shared executor of at
+    most ASYNC_WORKERS threads, and returns its AsyncResult. The Deadlines
+    of the calling thread also bound the call. """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPool(ASYNC_WORKERS)
+    return _executor.apply_async(_call_with_deadlines,
+                                 (list(_deadline_stack()),
+                                  function,
+                                  args,
+                                  kwargs))
+
+
+def _call_with_deadlines(deadlines, function, args, kwargs):
+    stack = _deadline_stack()
+    stack.extend(deadlines)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        del stack[len(stack) - len(deadlines):]
+
+
+class SshPool(object):
+    """ Process-wide pool of reusable ssh connections """
+    class __SshPool(object):
+        max_per_host = 4
+        max_idle_time = 300
+        wait_timeout = 60
+
+        def __init__(self):
+            self._cond = Condition(Lock())
+            self._idle = {}
+            self._size = {}
+
+        @contextmanager
+        def connection(self, credentials):
+            """ Borrows a client for the duration of a `with` block """
+            client = self.borrow(credentials)
+            discard = False
+            try:
+                yield client
+            except (ssh_exception.SSHException, socket.error, EOFError):
+                discard = True
+                raise
+            finally:
+                self.release(client, discard=discard)
+
+        def borrow(self, credentials):
+            """ Gets a healthy connected client, reusing an idle one if any """
+            key = _pool_key(credentials)
+            host = key[0]
+            deadline = time.time() + self.wait_timeout
+            while True:
+                with self._cond:
+                    self._evict_idle()
+                    idle = self._idle.get(key)
+                    if idle:
+                        client, _ = idle.pop()
+                    elif self._size.get(host, 0) < self.max_per_host or \
+                            self._evict_other(host, key):
+                        self._size[host] = self._size.get(host, 0) + 1
+                        client = None
+                    else:
+                        remaining = _remaining(deadline - time.time())
+                        if remaining <= 0:
+                            raise SshTimeoutError(
+                                "Timed out waiting for a free connection "
+                                "to " + host)
+                        self._cond.wait(remaining)
+                        continue
+
+                if client is None:
+                    try:
+                        client = SshClient(credentials)
+                    except Exception:
+                        self._forget(host)
+                        raise
+                    client._pool_key = key
+                    return client
+
+                if client.is_alive():
+                    return client
+                logging.getLogger("paramiko").\
+                    warning("Dropping dead pooled connection to " + host)
+                client.close_connection()
+                self._forget(host)
+
+        def release(self, client, discard=False):
+            """ Gives back a borrowed client to the pool """
+            key = getattr(client, '_pool_key', None)
+            if key is None:
+                client.close_connection()
+                return
+            if discard or not client.is_open():
+                client.close_connection()
+                self._forget(key[0])
+                return
+            with self._cond:
+                self._idle.setdefault(key, []).append((client, time.time()))
+                self._cond.notify()
+
+        def close_all(self):
+            """ Closes every idle connection """
+            with self._cond:
+                for key, idle in list(self._idle.items()):
+                    for idle_client, _ in idle:
+                        idle_client.close_connection()
+                        self._size[key[0]] -= 1
+                self._idle = {}
+                self._cond.notify_all()
+
+        def _forget(self, host):
+            with self._cond:
+                self._size[host] -= 1
+                self._cond.notify()
+
+        def _evict_other(self, host, key):
+            """ Closes the oldest idle connection to the host opened for
+            other credentials, lock must be held. False if there is none. """
+            others = [(last_used, idle_key)
+                      for idle_key, idle in self._idle.items()
+                      if idle_key[0] == host and idle_key != key
+                      for _, last_used in idle]
+            if not others:
+                return False
+            _, idle_key = min(others)
+            idle = self._idle[idle_key]
+            oldest = min(range(len(idle)), key=lambda index: idle[index][1])
+            idle.pop(oldest)[0].close_connection()
+            if not idle:
+                del self._idle[idle_key]
+            self._size[host] -= 1
+            return True
+
+        def _evict_idle(self):
+            """ Closes connections idle for too long, lock must be held """
+            limit = time.time() - self.max_idle_time
+            for key, idle in list(self._idle.items()):
+                fresh = []
+                for idle_client, last_used in idle:
+                    if last_used < limit:
+                        idle_client.close_connection()
+                        self._size[key[0]] -= 1
+                    else:
+                        fresh.append((idle_client, last_used))
+                if fresh:
+                    self._idle[key] = fresh
+                else:
+                    del self._idle[key]
+
+    instance = None
+
+    def __init__(self):
+        if not SshPool.instance:
+            SshPool.instance = SshPool.__SshPool()
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+class SshTimeoutError(ssh_exception.SSHException):
+    """ Raised when a remote call does not finish in time """
+    pass
 
-class Handler(SocketServer.BaseRequestHandler):
 
-    def handle(self):
+class SshCancelledError(ssh_exception.SSHException):
+    """ Raised by the remote calls of a cancelled Deadline """
+    pass
+
+
+class Deadline(object):
+    """ Bounds the time of the remote calls made by the thread in a `with`
+    block, that raise SshTimeoutError once it is reached. The calls running
+    in the block are cancelled from any other thread with cancel(), making
+    them raise SshCancelledError. Nested blocks keep the nearest deadline.
+    """
+
+    def __init__(self, timeout):
+        self.expires = time.time() + timeout
+        self.cancelled = False
+        self._lock = Lock()
+        self._readers = weakref.WeakSet()
+
+    def __enter__(self):
+        _deadline_stack().append(self)
+        return self
+
+    def __exit__(self, *args):
+        _deadline_stack().remove(self)
+
+    def remaining(self):
+        """ Seconds left to the deadline """
+        return self.expires - time.time()
+
+    def cancel(self):
+        """ Kills the commands running under the deadline, and makes the
+        next ones fail """
+        with self._lock:
+            self.cancelled = True
+            readers = list(self._readers)
+        for reader in readers:
+            reader.channel.close()
+
+    def track(self, reader):
+        """ Registers the reader of a command running under the deadline """
+        with self._lock:
+            self._readers.add(reader)
+
+
+def _deadline_stack():
+    if not hasattr(_deadlines, 'stack'):
+        _deadlines.stack = []
+    return _deadlines.stack
+
+
+def _remaining(timeout):
+    """ Seconds left to the timeout, or to the nearest Deadline of the
+    thread if it comes first. Raises SshCancelledError if cancelled. """
+    for deadline in _deadline_stack():
+        if deadline.cancelled:
+            raise SshCancelledError("Remote call cancelled")
+        timeout = min(timeout, deadline.remaining())
+    return timeout
+
+
+def benchmark_transport(credentials,
+                        output_size=BENCHMARK_OUTPUT_SIZE,
+                        candidates=None):
+    """ Measures the throughput of a synthetic scheduler output of
+    output_size bytes, with each candidate transport settings merged into
+    the credentials. By default compression and window sizes are tried.
+
+    Returns a list of (settings, bytes per second) tuples, fastest first.
+    The first settings are good defaults for the credentials of the host. """
+    if candidates is None:
+        candidates = [{'compress': compress, 'window_size': window_size}
+                      for compress in (False, True)
+                      for window_size in BENCHMARK_WINDOW_SIZES]
+    results = []
+    for settings in candidates:
+        ssh_client = SshClient(dict(credentials, **settings))
         try:
-            chan = self.ssh_transport.open_channel(
-                "direct-tcpip",
-                (self.chain_host, self.chain_port),
-                self.request.getpeername(),
-            )
-        except Exception as e:
-            verbose(
-                "Incoming request to %s:%d failed: %s"
-                % (self.chain_host, self.chain_port, repr(e))
-            )
-            return
-        if chan is None:
-            verbose(
-                "Incoming request to %s:%d was rejected by the SSH server."
-                % (self.chain_host, self.chain_port)
-            )
-            return
+            started = time.time()
+            output, exit_code = ssh_client.send_command(
+                BENCHMARK_COMMAND.format(output_size),
+                wait_result=True)
+            elapsed = time.time() - started
+        finally:
+            ssh_client.close_connection()
+        if exit_code == 0:
+            results.append((settings, len(output) / max(elapsed, 1e-6)))
+        else:
+            logging.getLogger(__name__).warning(
+                "Transport benchmark failed with %s: exit code %s",
+                settings, exit_code)
+    results.sort(key=lambda result: result[1], reverse=True)
+    return results
+
+
+def _connect_timeout():
+    """ Seconds to establish a connection, bounded by the deadlines """
+    timeout = _remaining(CONNECT_TIMEOUT)
+    if timeout <= 0:
+        raise SshTimeoutError("No time left to connect")
+    return timeout
+
+
+class SshCircuitOpenError(ssh_exception.SSHException):
+    """ Raised instead of connecting to a host that failed repeatedly,
+    until its cooldown is over """
+    pass
+
+
+class SshGovernor(object):
+    """ Process-wide admission control of the connections to each host.
+
+    Caps the concurrent handshakes, retries transient failures with
+    exponential backoff and full jitter, and opens a circuit breaker that
+    fails fast for cooldown seconds after failure_threshold connections
+    failed in a row. The counters of each host are given by stats(). """
+    class __SshGovernor(object):
+        max_handshakes = 4
+        retries = 5
+        backoff_base = 0.5
+        backoff_max = 30
+        failure_threshold = 3
+        cooldown = 60
+
+        def __init__(self):
+            self._lock = Lock()
+            self._hosts = {}
+
+        def connect(self, host, connect):
+            """ Calls connect, that opens a connection to the host, once
+            admitted, and returns its result """
+            state = self._state(host)
+            attempt = 0
+            while True:
+                self._admit(host, state)
+                waiting = time.time()
+                with state.handshakes:
+                    self._count(state,
+                                handshakes=1,
+                                wait_time=time.time() - waiting)
+                    try:
+                        result = connect()
+                    except Exception as err:
+                        if not _is_transient(err):
+                            raise
+                        if attempt >= self.retries:
+                            self._failed(host, state)
+                            raise
+                        error = err
+                    else:
+                        self._succeeded(state)
+                        return result
+
+                attempt += 1
+                delay = random.uniform(
+                    0,
+                    min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                if delay >= _remaining(delay + 1):
+                    raise SshTimeoutError("No time left to retry the SSH "
+                                          "connection to " + host + ": " +
+                                          str(error))
+                self._count(state, retries=1, backoff_time=delay)
+                logging.getLogger("paramiko").warning(
+                    "Retrying SSH connection to %s in %.1f seconds: %s",
+                    host, delay, error)
+                time.sleep(delay)
+
+        def stats(self):
+            """ Counters of every host, by host """
+            with self._lock:
+                return dict((host, dict(state.counters,
+                                        circuit_open=state.is_open()))
+                            for host, state in self._hosts.items())
 
-        # verbose(
-        #     "Connected!  Tunnel open %r -> %r -> %r"
-        #     % (
-        #         self.request.getpeername(),
-        #         chan.getpeername(),
-        #         (self.chain_host, self.chain_port),
-        #     )
-        # )
-        while True:
-            r, w, x = select.select([self.request, chan], [], [])
-            if self.request in r:
+        def reset(self, host=None):
+            """ Closes the circuit breaker of a host, or of all of them """
+            with self._lock:
+                states = (self._hosts.values() if host is None
+                          else [self._hosts.get(host)])
+                for state in states:
+                    if state is not None:
+                        state.failures = 0
+                        state.open_until = 0
+
+        def _state(self, host):
+            with self._lock:
+                state = self._hosts.get(host)
+                if state is None:
+                    state = _HostState(self.max_handshakes)
+                    self._hosts[host] = state
+                return state
+
+        def _admit(self, host, state):
+            with self._lock:
+                if not state.is_open():
+                    return
+                state.counters['rejected'] += 1
+                remaining = state.open_until - time.time()
+            raise SshCircuitOpenError(
+                "Too many failed connections to " + host +
+                ", not connecting for " + str(int(remaining) + 1) +
+                " seconds")
+
+        def _failed(self, host, state):
+            with self._lock:
+                state.counters['failures'] += 1
+                state.failures += 1
+                if state.failures >= self.failure_threshold:
+                    state.open_until = time.time() + self.cooldown
+                    state.counters['circuit_opened'] += 1
+                    logging.getLogger("paramiko").warning(
+                        "Circuit breaker open for %s during %s seconds",
+                        host, self.cooldown)
+
+        def _succeeded(self, state):
+            with self._lock:
+                state.counters['connections'] += 1
+                state.failures = 0
+                state.open_until = 0
+
+        def _count(self, state, **increments):
+            with self._lock:
+                for name, increment in increments.items():
+                    state.counters[name] += increment
+
+    instance = None
+
+    def __init__(self):
+        if not SshGovernor.instance:
+            SshGovernor.instance = SshGovernor.__SshGovernor()
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+class _HostState(object):
+
+    def __init__(self, max_handshakes):
+        self.handshakes = threading.BoundedSemaphore(max_handshakes)
+        self.failures = 0
+        self.open_until = 0
+        self.counters = {'connections': 0,
+                         'handshakes': 0,
+                         'retries': 0,
+                         'failures': 0,
+                         'rejected': 0,
+                         'circuit_opened': 0,
+                         'wait_time': 0.0,
+                         'backoff_time': 0.0}
+
+    def is_open(self):
+        return self.open_until > time.time()
+
+
+def _is_transient(err):
+    """ True if a connection failed for a reason worth retrying, as a
+    busy host dropping the handshake """
+    if isinstance(err, (socket.error, EOFError)):
+        return True
+    return isinstance(err, ssh_exception.SSHException) and \
+        "Error reading SSH protocol banner" in str(err)
+
+
+class SshJumpHosts(object):
+    """ Registry of the jump host sessions shared by all the clients behind
+    the same bastion. Sessions are reference counted, and closed once they
+    are idle for idle_timeout seconds. """
+    class __SshJumpHosts(object):
+        idle_timeout = 300
+
+        def __init__(self):
+            self._lock = Lock()
+            self._sessions = {}
+
+        def acquire(self, credentials):
+            """ Gets the connected session of a jump host """
+            key = _pool_key(credentials)
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None:
+                    session = _JumpHostSession()
+                    self._sessions[key] = session
+                session.refs += 1
+            try:
+                with session.lock:
+                    if session.client is not None and \
+                            not session.client.is_alive():
+                        session.client.close_connection()
+                        session.client = None
+                    if session.client is None:
+                        session.client = SshClient(credentials)
+                    return session.client
+            except Exception:
+                self.release(credentials)
+                raise
+
+        def release(self, credentials):
+            """ Stops using the session of a jump host """
+            key = _pool_key(credentials)
+            with self._lock:
+                session = self._sessions[key]
+                session.refs -= 1
+                if session.refs > 0:
+                    return
+                session.idle_since = time.time()
+                if session.timer is not None:
+                    session.timer.cancel()
+                session.timer = threading.Timer(self.idle_timeout,
+                                                self._expire,
+                                                (key,))
+                session.timer.daemon = True
+                session.timer.start()
+
+        def close_all(self):
+            """ Closes every jump host session """
+            with self._lock:
+                sessions = self._sessions.values()
+                self._sessions = {}
+            for session in sessions:
+                if session.timer is not None:
+                    session.timer.cancel()
+                if session.client is not None:
+                    session.client.close_connection()
+
+        def _expire(self, key):
+            with self._lock:
+                session = self._sessions.get(key)
+                if session is None or session.refs > 0 or \
+                        time.time() - session.idle_since < \
+                        self.idle_timeout * 0.99:
+                    return
+                del self._sessions[key]
+            if session.client is not None:
+                session.client.close_connection()
+
+    instance = None
+
+    def __init__(self):
+        if not SshJumpHosts.instance:
+            SshJumpHosts.instance = SshJumpHosts.__SshJumpHosts()
+
+    def __getattr__(self, name):
+        return getattr(self.instance, name)
+
+
+atexit.register(lambda: SshJumpHosts().close_all())
+
+
+class _JumpHostSession(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.client = None
+        self.refs = 0
+        self.idle_since = None
+        self.timer = None
+
+
+def load_private_key(key_data, password=None):
+    """ Parses a RSA, Ed25519, ECDSA or DSS private key.
+
+    Parsed keys are kept in memory only, in a bounded cache indexed by a
+    digest of the key and its password, so encrypted keys do not go through
+    the passphrase derivation on every connection. """
+    if not isinstance(key_data, unicode):
+        key_data = unicode(key_data, "utf-8")
+    digest = hashlib.sha256(key_data.encode('utf-8'))
+    if password:
+        digest.update(b'\0')
+        digest.update(password.encode('utf-8')
+                      if isinstance(password, unicode) else password)
+    digest = digest.digest()
+
+    with _private_keys_lock:
+        private_key = _private_keys.pop(digest, None)
+        if private_key is not None:
+            _private_keys[digest] = private_key  # most recently used
+            return private_key
+
+    error = None
+    for key_class in _PRIVATE_KEY_CLASSES:
+        try:
+            private_key = key_class.from_private_key(io.StringIO(key_data),
+                                                     password=password)
+            break
+        except ssh_exception.PasswordRequiredException:
+            raise
+        except (ssh_exception.SSHException, ValueError) as err:
+            error = error or err
+    else:
+        raise error
+
+    with _private_keys_lock:
+        _private_keys[digest] = private_key
+        while len(_private_keys) > PRIVATE_KEY_CACHE_SIZE:
+            _private_keys.popitem(last=False)
+    return private_key
+
+
+def _pool_key(credentials):
+    """ Identifies the connections that can be shared by some credentials """
+    tunnel = credentials.get('tunnel')
+    options = sorted((k, v) for k, v in credentials.items()
+                     if k not in ('host', 'user', 'port', 'tunnel'))
+    return (credentials['host'],
+            credentials.get('user'),
+            int(credentials.get('port', 22)),
+            _pool_key(tunnel) if tunnel else None,
+            hashlib.sha1(repr(options).encode('utf-8')).hexdigest())
+
+
+class SshForward(object):
+    """Forwards a local TCP port to the host through its tunnel.
+
+    SshClient does not need it, as it sends its traffic straight through a
+    channel of the tunnel. It is only meant for tools that require a TCP
+    endpoint. A single thread relays all the forwarded connections."""
+
+    def __init__(self, credentials):
+        self._tunnel_credentials = credentials['tunnel']
+        self._client = SshJumpHosts().acquire(self._tunnel_credentials)
+        self._chain = (credentials['host'],
+                       int(credentials['port']) if 'port' in credentials
+                       else 22)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(("127.0.0.1", 0))
+        self._server.listen(16)
+        self._port = self._server.getsockname()[1]
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def port(self):
+        return self._port
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        SshJumpHosts().release(self._tunnel_credentials)
+
+    def _serve(self):
+        peers = {}
+        while not self._closed:
+            readq, _, _ = select.select([self._server] + list(peers),
+                                        [],
+                                        [],
+                                        RELAY_POLL_PERIOD)
+            for endpoint in readq:
+                if endpoint is self._server:
+                    self._accept(peers)
+                    continue
+                if endpoint not in peers:  # closed in this same round
+                    continue
                 try:
-                    data = self.request.recv(1024)
+                    data = endpoint.recv(RELAY_BUFFER_SIZE)
+                    if data:
+                        peers[endpoint].sendall(data)
                 except socket.error as err:
-                    data = bytes('')
                     logging.getLogger("paramiko").\
-                        warning("Waiting for data: " + str(err))
-                if len(data) == 0:
-                    break
-                chan.send(data)
-            if chan in r:
-                data = chan.recv(1024)
-                if len(data) == 0:
-                    break
-                self.request.send(data)
-
-        # peername = self.request.getpeername()
-        chan.close()
-        self.request.close()
-        # verbose("Tunnel closed from %r" % (peername,))
-
-
-def verbose(s):
-    print(s)
-
-
-def get_host_port(spec, default_port):
-    "parse 'hostname:22' into a host and port, with the port optional"
-    args = (spec.split(":", 1) + [default_port])[:2]
-    args[1] = int(args[1])
-    return args[0], args[1]
+                        warning("Tunnel relay failed: " + str(err))
+                    data = None
+                if not data:
+                    peer = peers.pop(endpoint)
+                    del peers[peer]
+                    endpoint.close()
+                    peer.close()
+
+        for endpoint in peers:
+            endpoint.close()
+        self._server.close()
+
+    def _accept(self, peers):
+        request, origin = self._server.accept()
+        try:
+            chan = self._client.get_transport().open_channel(
+                "direct-tcpip",
+                self._chain,
+                origin)
+        except Exception as err:
+            logging.getLogger("paramiko").warning(
+                "Incoming request to %s:%d failed: %s"
+                % (self._chain[0], self._chain[1], repr(err)))
+            request.close()
+            return
+        request.setsockopt(socket.SOL_SOCKET,
+                           socket.SO_RCVBUF,
+                           RELAY_BUFFER_SIZE)
+        peers[request] = chan
+        peers[chan] = request
@@ -31,7 +31,7 @@ from cloudify import ctx
 from cloudify.decorators import operation
 from cloudify.exceptions import NonRecoverableError
 
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshPool
 from croupier_plugin.workload_managers.workload_manager import WorkloadManager
 from croupier_plugin.external_repositories.external_repository import (
     ExternalRepository)
@@ -109,31 +109,36 @@ def configure_execution(
 
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
+        pool = SshPool()
         try:
-            client = SshClient(credentials)
+            client = pool.borrow(credentials)
         except Exception as exp:
             raise NonRecoverableError(
                 "Failed trying to connect to workload manager: " + str(exp))
 
-        # TODO: use command according to wm
-        _, exit_code = client.execute_shell_command(
-            'uname',
-            wait_result=True)
+        try:
+            # TODO: use command according to wm
+            _, exit_code = client.execute_shell_command(
+                'uname',
+                wait_result=True)
 
-        if exit_code != 0:
-            client.close_connection()
-            raise NonRecoverableError(
-                "Failed executing on the workload manager: exit code " +
-                str(exit_code))
+            if exit_code != 0:
+                raise NonRecoverableError(
+                    "Failed executing on the workload manager: exit code " +
+                    str(exit_code))
 
-        ctx.instance.runtime_properties['login'] = exit_code == 0
+            ctx.instance.runtime_properties['login'] = exit_code == 0
 
-        prefix = workdir_prefix
-        if workdir_prefix == "":
-            prefix = ctx.blueprint.id
+            prefix = workdir_prefix
+            if workdir_prefix == "":
+                prefix = ctx.blueprint.id
 
-        workdir = wm.create_new_workdir(client, base_dir, prefix, ctx.logger)
-        client.close_connection()
+            workdir = wm.create_new_workdir(client,
+                                            base_dir,
+                                            prefix,
+                                            ctx.logger)
+        finally:
+            pool.release(client)
         if workdir is None:
             raise NonRecoverableError(
                 "failed to create the working directory, base dir: " +
@@ -171,11 +176,10 @@ def cleanup_execution(
 
         if 'credentials' in ctx.instance.runtime_properties:
             credentials = ctx.instance.runtime_properties['credentials']
-        client = SshClient(credentials)
-        client.execute_shell_command(
-            'rm -r ' + workdir,
-            wait_result=True)
-        client.close_connection()
+        with SshPool().connection(credentials) as client:
+            client.execute_shell_command(
+                'rm -r ' + workdir,
+                wait_result=True)
         ctx.logger.info('..all clean.')
     else:
         ctx.logger.warning('clean up simulated.')
@@ -290,6 +294,7 @@ def preconfigure_job(
         job_prefix,
         monitor_period,
         simulate,
+        monitor_events=False,
         **kwargs):  # pylint: disable=W0613
     """ Match the job with its credentials """
     ctx.logger.info('Preconfiguring job..')
@@ -314,6 +319,7 @@ def preconfigure_job(
     ctx.source.instance.runtime_properties['simulate'] = simulate
     ctx.source.instance.runtime_properties['job_prefix'] = job_prefix
     ctx.source.instance.runtime_properties['monitor_period'] = monitor_period
+    ctx.source.instance.runtime_properties['monitor_events'] = monitor_events
 
     ctx.source.instance.runtime_properties['workdir'] = \
         ctx.target.instance.runtime_properties['workdir']
@@ -417,38 +423,36 @@ def deploy_job(script,
 
     # Execute the script and manage the output
     success = False
-    client = SshClient(credentials)
-    if wm._create_shell_script(client,
-                               name,
-                               ctx.get_resource(script),
-                               logger,
-                               workdir=workdir):
-        call = "./" + name
-        for dinput in inputs:
-            str_input = str(dinput)
-            if ('\n' in str_input or ' ' in str_input) and str_input[0] != '"':
-                call += ' "' + str_input + '"'
+    with SshPool().connection(credentials) as client:
+        if wm._create_shell_script(client,
+                                   name,
+                                   ctx.get_resource(script),
+                                   logger,
+                                   workdir=workdir):
+            call = "./" + name
+            for dinput in inputs:
+                str_input = str(dinput)
+                if ('\n' in str_input or ' ' in str_input) and \
+                        str_input[0] != '"':
+                    call += ' "' + str_input + '"'
+                else:
+                    call += ' ' + str_input
+            # run the script and remove it in one round trip
+            calls = [call]
+            if not skip_cleanup:
+                calls.append("rm " + name)
+            results = client.execute_shell_batch(calls, workdir=workdir)
+            exit_code = results[0][2]
+            if exit_code != 0:
+                logger.warning(
+                    "failed to deploy job: call '" + call + "', exit code " +
+                    str(exit_code))
             else:
-                call += ' ' + str_input
-        _, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        if exit_code != 0:
-            logger.warning(
-                "failed to deploy job: call '" + call + "', exit code " +
-                str(exit_code))
-        else:
-            success = True
+                success = True
 
-        if not skip_cleanup:
-            if not client.execute_shell_command(
-                    "rm " + name,
-                    workdir=workdir):
+            if not skip_cleanup and results[1][2] != 0:
                 logger.warning("failed removing bootstrap script")
 
-    client.close_connection()
-
     return success
 
 
@@ -464,11 +468,9 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
     if not simulate:
         workdir = ctx.instance.runtime_properties['workdir']
         wm_type = ctx.instance.runtime_properties['workload_manager']
-        client = SshClient(ctx.instance.runtime_properties['credentials'])
 
         wm = WorkloadManager.factory(wm_type)
         if not wm:
-            client.close_connection()
             raise NonRecoverableError(
                 "Workload Manager '" +
                 wm_type +
@@ -477,14 +479,15 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
             'CFY_EXECUTION_ID': ctx.execution_id,
             'CFY_JOB_NAME': name
         }
-        is_submitted = wm.submit_job(client,
-                                     name,
-                                     job_options,
-                                     is_singularity,
-                                     ctx.logger,
-                                     workdir=workdir,
-                                     context=context_vars)
-        client.close_connection()
+        with SshPool().connection(
+                ctx.instance.runtime_properties['credentials']) as client:
+            is_submitted = wm.submit_job(client,
+                                         name,
+                                         job_options,
+                                         is_singularity,
+                                         ctx.logger,
+                                         workdir=workdir,
+                                         context=context_vars)
     else:
         ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
         is_submitted = True
@@ -498,6 +501,10 @@ def send_job(job_options, **kwargs):  # pylint: disable=W0613
             'Job ' + name + ' (' + ctx.instance.id + ') not sent.')
 
     ctx.instance.runtime_properties['job_name'] = name
+    # ID given by the workload manager, to look up the job by it
+    job_id = is_submitted if is_submitted is not True else None
+    ctx.instance.runtime_properties['job_id'] = job_id
+    return job_id
 
 
 @operation
@@ -520,23 +527,20 @@ def cleanup_job(job_options, skip, **kwargs):  # pylint: disable=W0613
             workdir = ctx.instance.runtime_properties['workdir']
             wm_type = ctx.instance.runtime_properties['workload_manager']
 
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
-
             wm = WorkloadManager.factory(wm_type)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError(
                     "Workload Manager '" +
                     wm_type +
                     "' not supported.")
-            is_clean = wm.clean_job_aux_files(client,
-                                              name,
-                                              job_options,
-                                              is_singularity,
-                                              ctx.logger,
-                                              workdir=workdir)
-
-            client.close_connection()
+            with SshPool().connection(
+                    ctx.instance.runtime_properties['credentials']) as client:
+                is_clean = wm.clean_job_aux_files(client,
+                                                  name,
+                                                  job_options,
+                                                  is_singularity,
+                                                  ctx.logger,
+                                                  workdir=workdir)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_clean = True
@@ -570,23 +574,23 @@ def stop_job(job_options, **kwargs):  # pylint: disable=W0613
         if not simulate:
             workdir = ctx.instance.runtime_properties['workdir']
             wm_type = ctx.instance.runtime_properties['workload_manager']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
 
             wm = WorkloadManager.factory(wm_type)
             if not wm:
-                client.close_connection()
                 raise NonRecoverableError(
                     "Workload Manager '" +
                     wm_type +
                     "' not supported.")
-            is_stopped = wm.stop_job(client,
-                                     name,
-                                     job_options,
-                                     is_singularity,
-                                     ctx.logger,
-                                     workdir=workdir)
-
-            client.close_connection()
+            with SshPool().connection(
+                    ctx.instance.runtime_properties['credentials']) as client:
+                is_stopped = wm.stop_job(
+                    client,
+                    name,
+                    job_options,
+                    is_singularity,
+                    ctx.logger,
+                    workdir=workdir,
+                    job_id=ctx.instance.runtime_properties.get('job_id'))
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
             is_stopped = True
@@ -622,21 +626,18 @@ def publish(publish_list, **kwargs):
         published = True
         if not simulate:
             workdir = ctx.instance.runtime_properties['workdir']
-            client = SshClient(ctx.instance.runtime_properties['credentials'])
-
-            for publish_item in publish_list:
-                if not published:
-                    break
-                exrep = ExternalRepository.factory(publish_item)
-                if not exrep:
-                    client.close_connection()
-                    raise NonRecoverableError(
-                        "External repository '" +
-                        publish_item['dataset']['type'] +
-                        "' not supported.")
-                published = exrep.publish(client, ctx.logger, workdir)
-
-            client.close_connection()
+            with SshPool().connection(
+                    ctx.instance.runtime_properties['credentials']) as client:
+                for publish_item in publish_list:
+                    if not published:
+                        break
+                    exrep = ExternalRepository.factory(publish_item)
+                    if not exrep:
+                        raise NonRecoverableError(
+                            "External repository '" +
+                            publish_item['dataset']['type'] +
+                            "' not supported.")
+                    published = exrep.publish(client, ctx.logger, workdir)
         else:
             ctx.logger.warning('Instance ' + ctx.instance.id + ' simulated')
 
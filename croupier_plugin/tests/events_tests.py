@@ -0,0 +1,115 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+events_tests.py: Holds the job events unit tests
+'''
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+
+from croupier_plugin import events
+from croupier_plugin.tests.ssh_server import StubSshServer
+from croupier_plugin.workload_managers import workload_manager
+
+
+class TestJobEvents(unittest.TestCase):
+    """ Holds job events tests against a local stub server """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubSshServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.close()
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.workdir)
+        # followers left behind by the stub server
+        self.addCleanup(subprocess.call, ['pkill', '-f', self.workdir])
+
+    def _log(self, name, state):
+        subprocess.check_call(
+            ['sh', '-c', workload_manager.event_call(name,
+                                                     state,
+                                                     self.workdir)])
+
+    def _wait_events(self, follower, expected):
+        started = time.time()
+        while dict((name, state) for name, (_, state)
+                   in follower.events().items()) != expected:
+            if time.time() - started > 10:
+                self.fail("Events not received: " + str(follower.events()))
+            threading.Event().wait(0.05)
+
+    def test_script_hooks(self):
+        """ Generated scripts log when they run and how they end """
+        for name, command, state in (('good', 'true', 'COMPLETED'),
+                                     ('bad', 'exit 3', 'FAILED'),
+                                     ('killed', 'kill -TERM $$; true',
+                                      'CANCELLED'),
+                                     ('stopped', 'kill -INT $$; true',
+                                      'CANCELLED')):
+            script = workload_manager._add_event_hooks(
+                '#!/bin/bash\n#SBATCH -t 1\n\n# DYNAMIC VARIABLES\n\n' +
+                command + '\n',
+                name,
+                self.workdir)
+            subprocess.call(['bash', '-c', script])
+            with open(os.path.join(self.workdir,
+                                   workload_manager.EVENTS_FILE)) as log:
+                self.assertEqual(log.readlines()[-2:],
+                                 [name + ' RUNNING\n', name + ' ' + state +
+                                  '\n'])
+
+    @mock.patch('croupier_plugin.events.FOLLOW_RETRY', 0.1)
+    def test_follow(self):
+        """ Events are received as they are logged, once each """
+        follower = events.EventFollower(self.server.credentials(),
+                                        self.workdir).start()
+        self.addCleanup(follower.stop)
+
+        self._log('job1', 'PENDING')
+        self._log('job2', 'PENDING')
+        self._log('job1', 'RUNNING')
+        self._wait_events(follower, {'job1': 'RUNNING', 'job2': 'PENDING'})
+        self.assertTrue(follower.alive)
+
+        # the log is followed again from where it was left
+        follower._client.close_connection()
+        self._log('job1', 'COMPLETED')
+        self._log('job2', 'UNKNOWN')
+        self._wait_events(follower, {'job1': 'COMPLETED', 'job2': 'PENDING'})
+        self.assertEqual(follower._lines, 5)
+
+        follower.stop()
+        self.assertFalse(follower.alive)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,390 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+job_requester_tests.py: Holds the job requester unit tests
+'''
+
+
+import logging
+import multiprocessing
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import mock
+from paramiko import ssh_exception
+
+from croupier_plugin import job_requester
+from croupier_plugin.ssh import SshTimeoutError
+
+
+def _monitor_jobs(*hosts, **kwargs):
+    return dict((host, {'config': {'host': host},
+                        'type': 'SLURM',
+                        'workdir': '/tmp',
+                        'names': [host + '_job'],
+                        'period': kwargs.get('period', 60)})
+                for host in hosts)
+
+
+def _running(workdir, config, names, logger, job_ids=None,
+             submitted=None):
+    return dict((name, 'RUNNING') for name in names)
+
+
+def _acquire(args):
+    directory, host = args
+    return job_requester.QueryBudget(directory, budget=10).acquire(host)
+
+
+class TestJobRequester(unittest.TestCase):
+    """ Holds job requester tests """
+
+    def setUp(self):
+        job_requester.JobRequester.instance = None
+        self.requester = job_requester.JobRequester().instance
+        self.requester._last_time = {}
+        self.requester._last_states = {}
+        self.requester._jobs = {}
+        self.requester._followers = {}
+        self.requester._throttled = {}
+        self.requester._stats = {'hits': 0, 'misses': 0, 'throttled': 0,
+                                 'invalidations': 0}
+        self.budget_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.budget_dir)
+        self.requester._budget = job_requester.QueryBudget(self.budget_dir,
+                                                           budget=1000)
+        patcher = mock.patch('croupier_plugin.job_requester.WorkloadManager')
+        self.factory = patcher.start().factory
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger('job_requester_tests')
+
+    def tearDown(self):
+        job_requester.JobRequester.instance = None
+
+    def test_request(self):
+        """ States of the jobs of every host """
+        self.factory.return_value.get_states.side_effect = _running
+
+        self.assertEqual(self.requester.request(_monitor_jobs('a', 'b'),
+                                                self.logger),
+                         {'a_job': 'RUNNING', 'b_job': 'RUNNING'})
+
+    def test_cached_states(self):
+        """ Hosts are answered from memory until their period is over """
+        self.factory.return_value.get_states.side_effect = _running
+        get_states = self.factory.return_value.get_states
+
+        for _ in range(3):
+            self.assertEqual(self.requester.request(_monitor_jobs('a', 'b'),
+                                                    self.logger),
+                             {'a_job': 'RUNNING', 'b_job': 'RUNNING'})
+        self.assertEqual(get_states.call_count, 2)
+
+        get_states.side_effect = lambda workdir, config, names, logger, \
+            job_ids, submitted: dict((name, 'COMPLETED') for name in names)
+        self.requester.invalidate('a')
+        self.assertEqual(self.requester.request(_monitor_jobs('a', 'b'),
+                                                self.logger),
+                         {'a_job': 'COMPLETED', 'b_job': 'RUNNING'})
+        self.assertEqual(get_states.call_count, 3)
+        self.assertEqual(self.requester.stats(),
+                         {'hits': 5, 'misses': 3, 'throttled': 0,
+                          'invalidations': 1})
+
+    def test_parallel_hosts(self):
+        """ Hosts are queried at the same time """
+        def get_states(workdir, config, names, logger, job_ids,
+                       submitted):
+            threading.Event().wait(0.5)
+            return _running(workdir, config, names, logger)
+        self.factory.return_value.get_states.side_effect = get_states
+
+        started = time.time()
+        states = self.requester.request(_monitor_jobs('a', 'b', 'c', 'd'),
+                                        self.logger)
+
+        self.assertEqual(len(states), 4)
+        self.assertLess(time.time() - started, 1.5)
+
+    def test_keep_last_states(self):
+        """ Hosts timing out keep their last known states """
+        slow = []
+
+        def get_states(workdir, config, names, logger, job_ids,
+                       submitted):
+            if config['host'] in slow:
+                raise SshTimeoutError("Remote command not finished")
+            return _running(workdir, config, names, logger)
+        self.factory.return_value.get_states.side_effect = get_states
+
+        self.assertEqual(self.requester.request(
+            _monitor_jobs('slow', 'b', period=0), self.logger),
+            {'slow_job': 'RUNNING', 'b_job': 'RUNNING'})
+        slow.append('slow')
+        self.assertEqual(self.requester.request(
+            _monitor_jobs('slow', 'new', period=0), self.logger),
+            {'slow_job': 'RUNNING', 'new_job': 'RUNNING'})
+        # jobs without known states are left out
+        monitor_jobs = _monitor_jobs('slow', period=0)
+        monitor_jobs['slow']['names'].append('slow_new_job')
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'slow_job': 'RUNNING'})
+
+    def test_host_errors(self):
+        """ Hosts failing in any way keep their last known states, and
+        the others are still answered """
+        errors = {}
+
+        def get_states(workdir, config, names, logger, job_ids,
+                       submitted):
+            if config['host'] in errors:
+                raise errors[config['host']]
+            return _running(workdir, config, names, logger)
+        self.factory.return_value.get_states.side_effect = get_states
+
+        monitor_jobs = _monitor_jobs('a', 'b', 'c', 'd', period=0)
+        self.requester.request(monitor_jobs, self.logger)
+        errors.update({'a': socket.error(111, "Connection refused"),
+                       'b': ssh_exception.AuthenticationException("denied"),
+                       'c': ValueError("unexpected output")})
+        monitor_jobs['d']['names'].append('d_new_job')
+
+        self.assertEqual(self.requester.request(monitor_jobs, self.logger),
+                         {'a_job': 'RUNNING', 'b_job': 'RUNNING',
+                          'c_job': 'RUNNING', 'd_job': 'RUNNING',
+                          'd_new_job': 'RUNNING'})
+
+    def _polls(self, monitor_jobs, states, seconds):
+        """ Seconds (of a fake clock) the jobs are polled on """
+        polls = []
+
+        def get_states(workdir, config, names, logger, job_ids,
+                       submitted):
+            polls.append(clock.time())
+            return dict((name, states[name]) for name in names)
+        self.factory.return_value.get_states.side_effect = get_states
+
+        with mock.patch('croupier_plugin.job_requester.time') as clock:
+            clock.time.return_value = 0
+            for now in seconds:
+                clock.time.return_value = now
+                self.requester.request(monitor_jobs, self.logger)
+        return polls
+
+    def test_pending_backoff(self):
+        """ Jobs that stay pending are polled less and less often """
+        states = {'a_job': 'PENDING'}
+        self.assertEqual(
+            self._polls(_monitor_jobs('a', period=10), states,
+                        range(0, 400, 10)),
+            [0, 10, 30, 70, 150, 310])
+
+        # a new job of the host is polled on the period
+        monitor_jobs = _monitor_jobs('a', period=10)
+        monitor_jobs['a']['names'].append('new_job')
+        states['new_job'] = 'RUNNING'
+        self.assertEqual(self._polls(monitor_jobs, states, [400, 410]),
+                         [400, 410])
+
+    def test_expected_completion(self):
+        """ Running jobs are polled on the period near their max_time """
+        monitor_jobs = _monitor_jobs('a', period=10)
+        monitor_jobs['a']['max_times'] = {'a_job': '00:05:00'}
+        self.assertEqual(
+            self._polls(monitor_jobs, {'a_job': 'RUNNING'},
+                        range(0, 340, 10)),
+            [0, 10, 30, 50, 70, 90, 110, 130, 150, 170, 190, 210, 230, 250,
+             270, 280, 290, 300, 310, 320, 330])
+
+    def test_running_backoff(self):
+        """ Running jobs without max_time are still polled often, to
+        notice when they end """
+        self.assertEqual(
+            self._polls(_monitor_jobs('a', period=10), {'a_job': 'RUNNING'},
+                        range(0, 200, 10)),
+            [0, 10] + range(30, 200, 20))
+
+    def test_final_states(self):
+        """ Jobs that are over are not tracked, nor hold the polls of the
+        rest of the jobs of the host """
+        monitor_jobs = _monitor_jobs('a', period=10)
+        monitor_jobs['a']['names'].append('done_job')
+        self.assertEqual(
+            self._polls(monitor_jobs,
+                        {'a_job': 'PENDING', 'done_job': 'COMPLETED'},
+                        range(0, 160, 10)),
+            [0, 10, 30, 70, 150])
+        self.assertEqual(self.requester._jobs.keys(), ['a_job'])
+
+    def test_forget(self):
+        """ Hosts not monitored anymore are forgotten """
+        self.factory.return_value.get_states.side_effect = _running
+        follower = mock.Mock(workdir='/tmp', alive=True)
+        follower.events.return_value = {}
+        self.requester._followers['a'] = follower
+        self.requester.request(_monitor_jobs('a', 'b'), self.logger)
+        self.requester._throttled['a'] = time.time() + 60
+
+        self.requester.forget('a')
+
+        follower.stop.assert_called_once_with()
+        self.assertEqual(self.requester._followers, {})
+        self.assertEqual(self.requester._jobs.keys(), ['b_job'])
+        self.assertEqual(self.requester._last_time.keys(), ['b'])
+        self.assertEqual(self.requester._last_states.keys(), ['b'])
+        self.assertEqual(self.requester._throttled, {})
+
+    def test_events(self):
+        """ Newer events prevail, and hosts with the events of all their
+        jobs followed are only polled to reconcile """
+        follower = mock.Mock(workdir='/tmp', alive=True)
+        follower.events.return_value = {}
+        self.requester._followers['a'] = follower
+        monitor_jobs = _monitor_jobs('a', period=10)
+        monitor_jobs['a']['events'] = True
+        self.factory.return_value.get_states.side_effect = \
+            lambda workdir, config, names, logger, job_ids, submitted: \
+            {'a_job': 'PENDING'}
+        get_states = self.factory.return_value.get_states
+
+        with mock.patch('croupier_plugin.job_requester.time') as clock:
+            clock.time.return_value = 0
+            self.assertEqual(self.requester.request(monitor_jobs,
+                                                    self.logger),
+                             {'a_job': 'PENDING'})
+            follower.events.return_value = {'a_job': (5, 'RUNNING')}
+            for now in range(5, 100, 5):
+                clock.time.return_value = now
+                self.assertEqual(self.requester.request(monitor_jobs,
+                                                        self.logger),
+                                 {'a_job': 'RUNNING'})
+            self.assertEqual(get_states.call_count, 1)
+
+            # the poll reconciles the states logged before it
+            clock.time.return_value = 100
+            self.assertEqual(self.requester.request(monitor_jobs,
+                                                    self.logger),
+                             {'a_job': 'PENDING'})
+            self.assertEqual(get_states.call_count, 2)
+
+    def test_query_budget(self):
+        """ Executions take queries from the same budget of each host """
+        budget = job_requester.QueryBudget(self.budget_dir, budget=2)
+        other = job_requester.QueryBudget(self.budget_dir, budget=2)
+
+        with mock.patch('croupier_plugin.job_requester.time') as clock:
+            clock.time.return_value = 1000
+            self.assertTrue(budget.acquire('a'))
+            self.assertTrue(other.acquire('a'))
+            self.assertFalse(budget.acquire('a'))
+            self.assertTrue(budget.acquire('b'))
+            clock.time.return_value = 1030  # a query every 30 seconds
+            self.assertTrue(other.acquire('a'))
+            self.assertFalse(budget.acquire('a'))
+
+        pool = multiprocessing.Pool(4)
+        try:
+            acquired = pool.map(_acquire, [(self.budget_dir, 'c')] * 40)
+        finally:
+            pool.close()
+            pool.join()
+        self.assertEqual(acquired.count(True), 10)
+
+    def test_budget_exhausted(self):
+        """ Hosts out of budget are answered with the freshest states """
+        self.factory.return_value.get_states.side_effect = _running
+        get_states = self.factory.return_value.get_states
+        self.requester._budget.budget = 1
+        self.assertEqual(self.requester.request(_monitor_jobs('a', period=0),
+                                                self.logger),
+                         {'a_job': 'RUNNING'})
+
+        # another execution of the manager reads a new state
+        job_requester.QueryBudget(self.budget_dir).share(
+            'a', {'a_job': 'COMPLETED'})
+        self.assertEqual(self.requester.request(_monitor_jobs('a', period=0),
+                                                self.logger),
+                         {'a_job': 'COMPLETED'})
+        self.assertEqual(get_states.call_count, 1)
+        self.assertEqual(self.requester.stats()['throttled'], 1)
+
+        # the budget is not asked again until it has a query
+        with mock.patch.object(self.requester._budget, 'take',
+                               wraps=self.requester._budget.take) as take:
+            self.assertEqual(self.requester.request(
+                _monitor_jobs('a', period=0), self.logger),
+                {'a_job': 'COMPLETED'})
+            self.assertEqual(take.call_count, 0)
+            self.requester._throttled['a'] = 0
+            self.requester.request(_monitor_jobs('a', period=0), self.logger)
+            self.assertEqual(take.call_count, 1)
+        self.assertEqual(self.requester.stats()['throttled'], 3)
+
+    def test_shared_states_expire(self):
+        """ States read long ago are no longer shared """
+        budget = job_requester.QueryBudget(self.budget_dir)
+        with mock.patch('croupier_plugin.job_requester.time') as clock:
+            clock.time.return_value = 1000
+            budget.share('a', {'old_job': 'RUNNING'})
+            clock.time.return_value += job_requester.SHARED_STATES_TTL
+            budget.share('a', {'new_job': 'PENDING'})
+            self.assertEqual(budget.shared_states('a'),
+                             {'new_job': 'PENDING'})
+            with budget._open('a') as bucket:
+                self.assertEqual(list(bucket['states']), ['new_job'])
+
+    def test_budget_directory(self):
+        """ Budgets are not kept where others may change them """
+        shared = os.path.join(self.budget_dir, 'shared')
+        os.mkdir(shared)
+        os.chmod(shared, 0o777)
+        self.assertRaises(job_requester.QueryBudgetError,
+                          job_requester.QueryBudget(shared).take, 'a')
+
+        link = os.path.join(self.budget_dir, 'link')
+        os.symlink(self.budget_dir, link)
+        self.assertRaises(job_requester.QueryBudgetError,
+                          job_requester.QueryBudget(link).take, 'a')
+
+        with mock.patch('croupier_plugin.job_requester.os.getuid',
+                        return_value=os.getuid() + 1):
+            self.assertRaises(job_requester.QueryBudgetError,
+                              self.requester._budget.take, 'a')
+            self.assertRaises(job_requester.QueryBudgetError,
+                              self.requester.request,
+                              _monitor_jobs('a'),
+                              self.logger)
+
+        budget = job_requester.QueryBudget(os.path.join(self.budget_dir,
+                                                        'new'))
+        self.assertEqual(budget.take('a'), 0)
+        self.assertEqual(os.stat(budget.directory).st_mode & 0o777, 0o700)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+monitor_service_tests.py: Holds the monitor service unit tests
+'''
+
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from croupier_plugin import job_requester, monitor_service
+
+
+def _monitor_jobs(names, user='user', workload_manager='SLURM',
+                  workdir='/tmp', events=False):
+    return {'hpc': {'config': {'host': 'hpc', 'user': user},
+                    'type': workload_manager,
+                    'workdir': workdir,
+                    'names': names,
+                    'period': 60,
+                    'events': events}}
+
+
+def _running(workdir, config, names, logger, job_ids=None,
+             submitted=None):
+    return dict((name, 'RUNNING') for name in names)
+
+
+class TestMonitorService(unittest.TestCase):
+    """ Holds monitor service tests, running it in the same process """
+
+    def setUp(self):
+        job_requester.JobRequester.instance = None
+        requester = job_requester.JobRequester().instance
+        requester._last_time = {}
+        requester._last_states = {}
+        requester._jobs = {}
+        requester._followers = {}
+        requester._throttled = {}
+        self.requester = requester
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        requester._budget = job_requester.QueryBudget(self.directory,
+                                                      budget=1000)
+        patcher = mock.patch('croupier_plugin.job_requester.WorkloadManager')
+        self.get_states = patcher.start().factory.return_value.get_states
+        self.get_states.side_effect = _running
+        self.addCleanup(patcher.stop)
+        self.logger = logging.getLogger('monitor_service_tests')
+
+        self.path = os.path.join(self.directory, 'service', 'monitor.sock')
+        self.service = monitor_service.MonitorService(self.path)
+        thread = threading.Thread(target=self.service.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.service.server_close)
+        self.addCleanup(self.service.shutdown)
+
+    def tearDown(self):
+        job_requester.JobRequester.instance = None
+
+    def _polled_names(self):
+        return [sorted(call[0][2]) for call in self.get_states.call_args_list]
+
+    def test_merged_queries(self):
+        """ Jobs of several executions are polled together """
+        first = monitor_service.get_requester(self.path)
+        second = monitor_service.get_requester(self.path)
+        self.assertIsInstance(first, monitor_service.MonitorServiceClient)
+
+        self.assertEqual(first.request(_monitor_jobs(['a1']), self.logger),
+                         {'a1': 'RUNNING'})
+        # new jobs are polled with the known ones
+        self.assertEqual(second.request(_monitor_jobs(['b1', 'b2']),
+                                        self.logger),
+                         {'b1': 'RUNNING', 'b2': 'RUNNING'})
+        for _ in range(3):
+            self.assertEqual(first.request(_monitor_jobs(['a1']),
+                                           self.logger),
+                             {'a1': 'RUNNING'})
+            self.assertEqual(second.request(_monitor_jobs(['b1']),
+                                            self.logger),
+                             {'b1': 'RUNNING'})
+        self.assertEqual(self._polled_names(), [['a1'], ['a1', 'b1', 'b2']])
+
+        # polled again when a job is sent or cancelled
+        first.invalidate('hpc')
+        self.assertEqual(first.request(_monitor_jobs(['a1']), self.logger),
+                         {'a1': 'RUNNING'})
+        self.assertEqual(self._polled_names()[-1], ['a1', 'b1', 'b2'])
+
+    def test_separate_users(self):
+        """ Jobs of other users are not polled together """
+        client = monitor_service.get_requester(self.path)
+
+        client.request(_monitor_jobs(['a1']), self.logger)
+        client.request(_monitor_jobs(['b1'], user='other'), self.logger)
+        self.assertEqual(self._polled_names(), [['a1'], ['b1']])
+
+    def test_active_workdir(self):
+        """ Merged queries run in the working directory of the execution
+        that asked last """
+        client = monitor_service.get_requester(self.path)
+
+        client.request(_monitor_jobs(['a1'], workdir='/first'), self.logger)
+        client.request(_monitor_jobs(['b1'], workdir='/second'), self.logger)
+        self.assertEqual(self.get_states.call_args[0][0], '/second')
+        client.invalidate('hpc')
+        client.request(_monitor_jobs(['a1'], workdir='/first'), self.logger)
+        self.assertEqual(self.get_states.call_args[0][0], '/first')
+
+    def test_host_budget(self):
+        """ Merged queries take from the budget of the host, shared with
+        the executions polling by themselves """
+        client = monitor_service.get_requester(self.path)
+
+        client.request(_monitor_jobs(['a1']), self.logger)
+        self.assertEqual(self.requester._budget.shared_states('hpc'),
+                         {'a1': 'RUNNING'})
+
+    @mock.patch('croupier_plugin.monitor_service.time')
+    def test_expired_follower(self, clock):
+        """ Events are no longer followed once nobody asks for them """
+        client = monitor_service.get_requester(self.path)
+        follower = mock.Mock(workdir='/tmp', alive=True)
+        follower.events.return_value = {}
+        self.requester._followers['user@hpc:/tmp'] = follower
+
+        clock.time.return_value = 1000
+        client.request(_monitor_jobs(['a1'], events=True), self.logger)
+        client.request(_monitor_jobs(['b1'], user='other'), self.logger)
+        follower.stop.assert_not_called()
+        clock.time.return_value += \
+            60 * monitor_service.SUBSCRIPTION_PERIODS + 1
+        client.request(_monitor_jobs(['b1'], user='other'), self.logger)
+
+        follower.stop.assert_called_once_with()
+        self.assertNotIn('user@hpc:/tmp', self.requester._followers)
+
+    def test_private_socket(self):
+        """ Requests are only sent to a socket nobody else may reach """
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        os.chmod(os.path.dirname(self.path), 0o755)
+
+        self.assertIsInstance(monitor_service.get_requester(self.path),
+                              job_requester.JobRequester)
+        client = monitor_service.MonitorServiceClient(self.path)
+        with mock.patch.object(self.service, 'request') as request:
+            self.assertEqual(client.request(_monitor_jobs(['a1']),
+                                            self.logger),
+                             {'a1': 'RUNNING'})
+        request.assert_not_called()
+
+        # nor a service is started there
+        self.assertRaises(EnvironmentError,
+                          monitor_service.MonitorService,
+                          os.path.join(os.path.dirname(self.path),
+                                       'other.sock'))
+
+    def test_no_service(self):
+        """ Executions monitor their jobs if the service is not running """
+        self.service.server_close()
+
+        self.assertIsInstance(monitor_service.get_requester(self.path),
+                              job_requester.JobRequester)
+        client = monitor_service.MonitorServiceClient(self.path)
+        self.assertEqual(client.request(_monitor_jobs(['a1']), self.logger),
+                         {'a1': 'RUNNING'})
+
+
+if __name__ == '__main__':
+    unittest.main()
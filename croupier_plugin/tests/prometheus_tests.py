@@ -0,0 +1,208 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+prometheus_tests.py: Holds the Prometheus client unit tests
+'''
+
+
+import json
+import re
+import threading
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import mock
+import requests
+
+from croupier_plugin import prometheus
+
+
+class _PrometheusServer(ThreadingMixIn, HTTPServer):
+    """ Answers the job_status queries with the jobs it publishes """
+    daemon_threads = True
+
+    def __init__(self, jobs):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _PrometheusHandler)
+        self.jobs = jobs  # (host, name): state int
+        self.queries = []
+        self.connections = 0
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        query = urlparse.parse_qs(body)['query'][0]
+        self.server.queries.append(query)
+        match = re.match(r'job_status\{job=~"((?:[^"\\]|\\.)*)",'
+                         r'name=~"((?:[^"\\]|\\.)*)"\}$', query)
+        if self.path != '/api/v1/query' or not match:
+            return self._reply(400, {'status': 'error',
+                                     'error': 'bad query'})
+        jobs, names = [re.compile('(?:' + re.sub(r'\\(.)', r'\1', group) +
+                                  ')$')
+                       for group in match.groups()]
+        self._reply(200, {
+            'status': 'success',
+            'data': {'resultType': 'vector', 'result': [
+                {'metric': {'job': job, 'name': name},
+                 'value': [0, str(state)]}
+                for (job, name), state in self.server.jobs.items()
+                if jobs.match(job) and names.match(name)]}})
+
+    def _reply(self, code, payload):
+        content = json.dumps(payload)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPrometheusClient(unittest.TestCase):
+    """ Holds Prometheus client tests """
+
+    def setUp(self):
+        self.server = _PrometheusServer({('hpc', 'job1'): 10,
+                                         ('hpc', 'job2'): 2,
+                                         ('other', 'job3'): 10})
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def test_get_states(self):
+        """ States of the jobs of a host, on a single connection """
+        client = prometheus.PrometheusClient(self.url, cache_ttl=0)
+        self.addCleanup(client.close)
+
+        for _ in range(3):
+            self.assertEqual(
+                client.get_states('hpc', ['job1', 'job2', 'job3'], 5),
+                {'job1': 'RUNNING', 'job2': 'COMPLETED'})
+        self.assertEqual(client.get_states('other', ['job3'], 5),
+                         {'job3': 'RUNNING'})
+        self.assertEqual(client.get_states('unknown', ['job1'], 5), {})
+        self.assertEqual(len(self.server.queries), 5)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.queries[0],
+                         'job_status{job=~"hpc",name=~"job1|job2|job3"}')
+
+    def test_many_names(self):
+        """ Large sets of names are read in chunks, matched literally """
+        names = ['job.{}'.format(i) for i in range(1000)]
+        self.server.jobs = dict((('hpc', name), 10) for name in names)
+        self.server.jobs[('hpc', 'jobX1')] = 10
+        client = prometheus.PrometheusClient(self.url)
+        self.addCleanup(client.close)
+
+        states = client.get_states('hpc', names + ['job"1'], 5)
+
+        self.assertEqual(states, dict((name, 'RUNNING') for name in names))
+        self.assertEqual(len(self.server.queries), 6)
+
+    def test_asked_hosts(self):
+        """ The jobs asked for every host are read together """
+        client = prometheus.PrometheusClient(self.url, cache_ttl=60)
+        self.addCleanup(client.close)
+
+        with mock.patch('croupier_plugin.prometheus.time') as clock:
+            clock.time.return_value = 1000
+            client.get_states('hpc', ['job1'], 5)
+            client.get_states('other', ['job3'], 5)
+            self.assertEqual(len(self.server.queries), 2)
+
+            clock.time.return_value += 60
+            self.assertEqual(client.get_states('hpc', ['job1'], 5),
+                             {'job1': 'RUNNING'})
+            self.assertEqual(client.get_states('other', ['job3'], 5),
+                             {'job3': 'RUNNING'})
+            self.assertEqual(self.server.queries[2:],
+                             ['job_status{job=~"hpc|other",'
+                              'name=~"job1|job3"}'])
+
+            # jobs not asked for anymore are left out
+            clock.time.return_value += prometheus.ASKED_TTL
+            client.get_states('hpc', ['job2'], 5)
+            self.assertEqual(self.server.queries[3],
+                             'job_status{job=~"hpc",name=~"job2"}')
+
+    def test_cache(self):
+        """ Hosts of the same endpoint share recent results """
+        client = prometheus.get_client(self.url)
+        self.addCleanup(client.close)
+        self.assertIs(prometheus.get_client(self.url), client)
+
+        self.assertEqual(client.get_states('hpc', ['job1'], 5),
+                         {'job1': 'RUNNING'})
+        self.server.jobs[('hpc', 'job1')] = 2
+        self.assertEqual(prometheus.get_client(self.url).get_states(
+            'hpc', ['job1'], 5), {'job1': 'RUNNING'})
+        self.assertEqual(len(self.server.queries), 1)
+
+        client.cache_ttl = 0
+        self.assertEqual(client.get_states('hpc', ['job1'], 5),
+                         {'job1': 'COMPLETED'})
+
+    def test_concurrent_hosts(self):
+        """ Hosts asking at the same time wait for the same query """
+        client = prometheus.PrometheusClient(self.url)
+        self.addCleanup(client.close)
+        for host in ('hpc', 'other'):
+            client.get_states(host, ['job1', 'job3'], 5)
+        client._read.clear()  # expired
+        del self.server.queries[:]
+        results = {}
+
+        def get_states(host):
+            results[host] = client.get_states(host, ['job1', 'job3'], 5)
+        threads = [threading.Thread(target=get_states, args=(host,))
+                   for host in ('hpc', 'other')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, {'hpc': {'job1': 'RUNNING'},
+                                   'other': {'job3': 'RUNNING'}})
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_query_error(self):
+        """ Failed queries raise """
+        client = prometheus.PrometheusClient(self.url)
+        self.addCleanup(client.close)
+
+        with self.assertRaises(requests.RequestException):
+            client.query('up', 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,367 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+slurm_rest_tests.py: Holds the Slurm REST API unit tests
+'''
+
+
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import mock
+
+from croupier_plugin.ssh import SshClient
+from croupier_plugin.workload_managers import slurm_rest
+from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+
+_TOKEN = 'secret'
+
+
+class _SlurmRestServer(ThreadingMixIn, HTTPServer):
+    """ Sends, lists and cancels jobs like slurmrestd. Jobs that left the
+    controller are only listed by the accounting database. """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _SlurmRestHandler)
+        self.jobs = {}  # id: job of the controller
+        self.accounting = []  # jobs of the accounting database
+        self.submitted = []
+        self.requests = []
+        self.connections = 0
+
+
+class _SlurmRestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        self.server.requests.append(('GET', url.path,
+                                     urlparse.parse_qs(url.query)))
+        if not self._authorized():
+            return
+        if url.path == '/slurm/v0.0.36/jobs':
+            self._reply(200, {'jobs': self.server.jobs.values(),
+                              'errors': []})
+        elif re.match(r'/slurm/v0.0.36/job/\d+$', url.path):
+            job = self.server.jobs.get(int(url.path.split('/')[-1]))
+            if job is None:
+                self._reply(500, {'errors': [{'error': 'Invalid job id'}]})
+            else:
+                self._reply(200, {'jobs': [job], 'errors': []})
+        elif url.path == '/slurmdb/v0.0.36/jobs':
+            self._reply(200, {'jobs': self.server.accounting, 'errors': []})
+        else:
+            self._reply(404, {'errors': [{'error': 'Not found'}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.requests.append(('POST', self.path, None))
+        if not self._authorized():
+            return
+        submission = json.loads(body)
+        self.server.submitted.append(submission)
+        job_id = 100 + len(self.server.submitted)
+        self.server.jobs[job_id] = {
+            'job_id': job_id,
+            'name': submission['job']['name'],
+            'job_state': 'PENDING',
+            'user_name': self.headers['X-SLURM-USER-NAME']}
+        self._reply(200, {'job_id': job_id, 'errors': []})
+
+    def do_DELETE(self):
+        self.server.requests.append(('DELETE', self.path, None))
+        if not self._authorized():
+            return
+        match = re.match(r'/slurm/v0.0.36/job/(\d+)$', self.path)
+        job = self.server.jobs.get(int(match.group(1))) if match else None
+        if job is None:
+            return self._reply(500, {'errors': [{'error': 'Invalid job'}]})
+        job['job_state'] = 'CANCELLED'
+        self._reply(200, {'errors': []})
+
+    def _authorized(self):
+        if self.headers.get('X-SLURM-USER-TOKEN') != _TOKEN:
+            self._reply(401, {'errors': [{'error': 'Authentication failure'}]})
+            return False
+        return True
+
+    def _reply(self, code, payload):
+        content = json.dumps(payload)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSlurmRest(unittest.TestCase):
+    """ Holds Slurm REST API tests against a local stub server """
+
+    def setUp(self):
+        self.server = _SlurmRestServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.credentials = {
+            'host': 'hpc',
+            'user': 'user',
+            'rest_url': 'http://127.0.0.1:{}/'.format(
+                self.server.server_port),
+            'rest_token': _TOKEN}
+        # keep-alive connections are closed before the server
+        self.addCleanup(
+            slurm_rest.get_session(self.credentials['rest_url'].rstrip('/'))
+            .close)
+        self.ssh_client = mock.Mock(spec=SshClient,
+                                    credentials=self.credentials)
+        self.ssh_client.execute_shell_command.return_value = (
+            '/work/dir\nHOME=/home/user\0USER=user\0'
+            'PATH=/opt/bin:/usr/bin\0_=/usr/bin/env\0', 0)
+        self.wm = WorkloadManager.factory('SLURM_REST')
+        self.logger = logging.getLogger('slurm_rest_tests')
+
+    def test_factory(self):
+        """ The REST API is selected by its workload manager type """
+        self.assertIsInstance(self.wm, slurm_rest.SlurmRest)
+
+    def test_submit_job(self):
+        """ Jobs are sent with their options in the job description """
+        job_id = self.wm.submit_job(self.ssh_client,
+                                    'job',
+                                    {'type': 'SBATCH',
+                                     'command': 'job.sh arg',
+                                     'pre': ['module load x'],
+                                     'max_time': '00:01:30',
+                                     'partition': 'thin',
+                                     'nodes': 2,
+                                     'memory': '2G',
+                                     'scale': 4,
+                                     'scale_max_in_parallel': 2},
+                                    False,
+                                    self.logger,
+                                    workdir='/work/dir',
+                                    context={'CFY_JOB_NAME': 'job'})
+
+        self.assertEqual(job_id, '101')
+        submission = self.server.submitted[0]
+        self.assertEqual(submission['job'], {
+            'name': 'job',
+            'environment': {'HOME': '/home/user',
+                            'USER': 'user',
+                            'PATH': '/opt/bin:/usr/bin',
+                            'CFY_JOB_NAME': 'job'},
+            'standard_output': 'job.out',
+            'standard_error': 'job.err',
+            'current_working_directory': '/work/dir',
+            'time_limit': 2,
+            'memory_per_node': 2048,
+            'partition': 'thin',
+            'nodes': 2,
+            'array': '0-3%2'})
+        self.assertEqual(submission['script'],
+                         '#!/bin/bash -l\n\n# DYNAMIC VARIABLES\n'
+                         'export SCALE_INDEX=$SLURM_ARRAY_TASK_ID\n'
+                         'export SCALE_COUNT=$SLURM_ARRAY_TASK_COUNT\n'
+                         'export SCALE_MAX=2\n\n'
+                         'module load x\n'
+                         'bash job.sh arg\n')
+        self.ssh_client.execute_shell_batch.assert_not_called()
+        self.ssh_client.execute_shell_command.assert_called_once_with(
+            'pwd && env -0', workdir='/work/dir', wait_result=True)
+
+    def test_scale_variables(self):
+        """ Commands of job arrays get the variables of their task """
+        workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, workdir)
+        with open(os.path.join(workdir, 'job.sh'), 'w') as command:
+            command.write('echo $SCALE_INDEX $SCALE_COUNT $SCALE_MAX\n')
+        self.wm.submit_job(self.ssh_client,
+                           'job',
+                           {'type': 'SBATCH',
+                            'command': 'job.sh',
+                            'scale': 4},
+                           False,
+                           self.logger,
+                           workdir=workdir)
+
+        output = subprocess.check_output(
+            ['bash', '-c', self.server.submitted[0]['script']],
+            cwd=workdir,
+            env=dict(os.environ,
+                     SLURM_ARRAY_TASK_ID='3',
+                     SLURM_ARRAY_TASK_COUNT='4'))
+        self.assertEqual(output, '3 4 4\n')
+
+    def test_submit_home_workdir(self):
+        """ Working directories are sent as absolute paths """
+        self.ssh_client.execute_shell_command.return_value = (
+            '/home/user/croupier_x\nHOME=/home/user\0', 0)
+
+        self.assertEqual(self.wm.submit_job(self.ssh_client,
+                                            'job',
+                                            {'type': 'SBATCH',
+                                             'command': 'job.sh'},
+                                            False,
+                                            self.logger,
+                                            workdir='$HOME/croupier_x'),
+                         '101')
+
+        self.ssh_client.execute_shell_command.assert_called_once_with(
+            'pwd && env -0', workdir='$HOME/croupier_x', wait_result=True)
+        self.assertEqual(
+            self.server.submitted[0]['job']['current_working_directory'],
+            '/home/user/croupier_x')
+
+        self.ssh_client.execute_shell_command.return_value = ('', 1)
+        self.assertFalse(self.wm.submit_job(self.ssh_client,
+                                            'job',
+                                            {'type': 'SBATCH',
+                                             'command': 'job.sh'},
+                                            False,
+                                            self.logger,
+                                            workdir='$HOME/missing'))
+        self.assertEqual(len(self.server.submitted), 1)
+
+    def test_submit_errors(self):
+        """ Rejected jobs are not sent """
+        self.assertFalse(self.wm.submit_job(self.ssh_client,
+                                            'job',
+                                            {'type': 'SBATCH',
+                                             'command': 'job.sh',
+                                             'max_time': 'soon'},
+                                            False,
+                                            self.logger))
+        self.assertEqual(self.server.submitted, [])
+
+        self.credentials['rest_token'] = 'wrong'
+        self.assertFalse(self.wm.submit_job(self.ssh_client,
+                                            'job',
+                                            {'type': 'SBATCH',
+                                             'command': 'job.sh'},
+                                            False,
+                                            self.logger))
+
+    def test_get_states(self):
+        """ Jobs with an ID are read by it, only the jobs without one are
+        looked up in the list of jobs. Jobs that left the controller are
+        looked up in the accounting database, since they were sent. Every
+        call uses the same connection. """
+        for name in ('job1', 'job2'):
+            self.wm.submit_job(self.ssh_client,
+                               name,
+                               {'type': 'SBATCH', 'command': 'job.sh'},
+                               False,
+                               self.logger)
+        self.server.jobs[101]['job_state'] = 'RUNNING'
+        self.server.jobs[300] = {'job_id': 300, 'name': 'job1',
+                                 'job_state': 'FAILED',
+                                 'user_name': 'other'}
+        self.server.accounting = [
+            {'job_id': 102, 'name': 'job2',
+             'state': {'current': 'COMPLETED'}},
+            {'job_id': 90, 'name': 'job3',
+             'state': {'current': 'TIMEOUT'}}]
+        del self.server.jobs[102]
+        del self.server.requests[:]
+
+        states = self.wm.get_states('/work/dir',
+                                    self.credentials,
+                                    ['job1', 'job2', 'job3'],
+                                    self.logger,
+                                    job_ids={'job1': '101', 'job2': '102'},
+                                    submitted={'job1': 10000,
+                                               'job2': 10000,
+                                               'job3': 20000})
+
+        self.assertEqual(states, {'job1': 'RUNNING',
+                                  'job2': 'COMPLETED',
+                                  'job3': 'TIMEOUT'})
+        self.assertEqual(self.server.requests, [
+            ('GET', '/slurm/v0.0.36/job/101', {}),
+            ('GET', '/slurm/v0.0.36/job/102', {}),
+            ('GET', '/slurm/v0.0.36/jobs', {}),
+            ('GET', '/slurmdb/v0.0.36/jobs',
+             {'users': ['user'],
+              'start_time': [str(10000 - slurm_rest.SACCT_WINDOW_MARGIN)]})])
+        self.assertEqual(self.server.connections, 1)
+
+        self.server.jobs[102] = {'job_id': 102, 'name': 'job2',
+                                 'job_state': ['COMPLETING']}
+        del self.server.requests[:]
+        self.assertEqual(self.wm.get_states('/work/dir',
+                                            self.credentials,
+                                            ['job1', 'job2'],
+                                            self.logger,
+                                            job_ids={'job1': '101',
+                                                     'job2': '102'}),
+                         {'job1': 'RUNNING', 'job2': 'COMPLETING'})
+        self.assertEqual([path for _, path, _ in self.server.requests],
+                         ['/slurm/v0.0.36/job/101', '/slurm/v0.0.36/job/102'])
+
+    def test_get_states_failed(self):
+        """ No states are given if the controller can't be reached """
+        self.credentials['rest_token'] = 'wrong'
+        self.assertEqual(self.wm.get_states('/work/dir',
+                                            self.credentials,
+                                            ['job1'],
+                                            self.logger), {})
+
+    def test_stop_job(self):
+        """ Jobs are cancelled by ID, or by name if they have none """
+        for name in ('job1', 'job2', 'job2'):
+            self.wm.submit_job(self.ssh_client,
+                               name,
+                               {'type': 'SBATCH', 'command': 'job.sh'},
+                               False,
+                               self.logger)
+
+        self.assertTrue(self.wm.stop_job(self.ssh_client, 'job1', {}, False,
+                                         self.logger, job_id='101'))
+        self.assertTrue(self.wm.stop_job(self.ssh_client, 'job2', {}, False,
+                                         self.logger))
+        self.assertEqual([job['job_state'] for _, job in
+                          sorted(self.server.jobs.items())],
+                         ['CANCELLED', 'CANCELLED', 'CANCELLED'])
+
+        self.assertFalse(self.wm.stop_job(self.ssh_client, 'job3', {}, False,
+                                          self.logger, job_id='999'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,7 +28,12 @@ slurm_tests.py: Holds the Slurm unit tests
 import logging
 import unittest
 
-from croupier_plugin.workload_managers.workload_manager import WorkloadManager
+import mock
+
+from croupier_plugin.ssh import SshClient
+from croupier_plugin.workload_managers.workload_manager import (
+    WorkloadManager,
+    parse_max_time)
 
 
 class TestSlurm(unittest.TestCase):
@@ -236,6 +241,207 @@ class TestSlurm(unittest.TestCase):
 
         self.assertEqual(len(names), len(set(names)))
 
+    def test_parse_max_time(self):
+        """ Time limits in the workload manager formats """
+        self.assertEqual(parse_max_time('30'), 1800)
+        self.assertEqual(parse_max_time(5), 300)
+        self.assertEqual(parse_max_time('05:30'), 330)
+        self.assertEqual(parse_max_time('01:00:05'), 3605)
+        self.assertEqual(parse_max_time('1-2'), 93600)
+        self.assertEqual(parse_max_time('1-00:01'), 86460)
+        self.assertEqual(parse_max_time('1-00:00:01'), 86401)
+        self.assertIsNone(parse_max_time('unlimited'))
+        self.assertIsNone(parse_max_time(None))
+
+    def test_new_workdir_taken(self):
+        """ Alternative workdir used if the preferred one exists """
+        ssh_client = mock.Mock()
+        ssh_client.run_many.side_effect = [[('', '', 0)],
+                                           [('', '', 0), ('', '', 1),
+                                            ('', '', 1)]]
+        ssh_client.execute_shell_command.return_value = True
+
+        workdir = self.wm.create_new_workdir(ssh_client, 'base', 'test',
+                                             self.logger)
+
+        self.assertEqual(ssh_client.run_many.call_count, 2)
+        self.assertEqual(len(ssh_client.run_many.call_args[0][0]), 3)
+        self.assertEqual(len(workdir), len('base/test_20190101_000000_'
+                                           'XXXXXX'))
+        ssh_client.execute_shell_command.assert_called_once_with(
+            'mkdir -p ' + workdir)
+
+    def test_new_workdir_free(self):
+        """ Only the preferred workdir is probed if it is free """
+        ssh_client = mock.Mock()
+        ssh_client.run_many.return_value = [('', '', 1)]
+        ssh_client.execute_shell_command.return_value = True
+
+        workdir = self.wm.create_new_workdir(ssh_client, 'base', 'test',
+                                             self.logger)
+
+        self.assertEqual(len(ssh_client.run_many.call_args[0][0]), 1)
+        ssh_client.execute_shell_command.assert_called_once_with(
+            'mkdir -p ' + workdir)
+
+    def test_new_workdir_unknown(self):
+        """ Workdirs that could not be checked are not used """
+        ssh_client = mock.Mock()
+        ssh_client.run_many.return_value = [(None, None, None)]
+
+        self.assertIsNone(self.wm.create_new_workdir(ssh_client, 'base',
+                                                     'test', self.logger))
+        ssh_client.execute_shell_command.assert_not_called()
+
+    def test_async_operations(self):
+        """ Job operations run in the background """
+        ssh_client = mock.Mock()
+        with mock.patch('croupier_plugin.workload_managers.workload_manager.'
+                        'SshPool') as pool, \
+                mock.patch.object(self.wm, 'stop_job',
+                                  return_value=True) as stop_job, \
+                mock.patch.object(self.wm, 'get_states',
+                                  return_value={'job': 'RUNNING'}):
+            pool.return_value.connection.return_value.__enter__.\
+                return_value = ssh_client
+            stopped = self.wm.stop_job_async({'host': 'hpc'}, 'job', {},
+                                             False, self.logger)
+            states = self.wm.get_states_async('dir', {'host': 'hpc'},
+                                              ['job'], self.logger)
+
+            self.assertTrue(stopped.get(10))
+            self.assertEqual(states.get(10), {'job': 'RUNNING'})
+        stop_job.assert_called_once_with(ssh_client, 'job', {}, False,
+                                         self.logger, workdir=None,
+                                         job_id=None)
+
+    def test_submit_job_id(self):
+        """ The ID given by sbatch is returned """
+        ssh_client = mock.Mock(spec=SshClient)
+        ssh_client.execute_shell_batch.return_value = [
+            ('pre output\n12345;cluster\n', '', 0)]
+
+        job_id = self.wm.submit_job(ssh_client,
+                                    'job',
+                                    {'type': 'SBATCH', 'command': 'job.sh'},
+                                    False,
+                                    self.logger)
+
+        self.assertEqual(job_id, '12345')
+        ssh_client.execute_shell_batch.return_value = [('', '', 0)]
+        self.assertIs(self.wm.submit_job(ssh_client,
+                                         'job',
+                                         {'type': 'SRUN',
+                                          'command': 'job.sh',
+                                          'max_time': '00:01:00'},
+                                         False,
+                                         self.logger), True)
+
+    def test_cancellation_call(self):
+        """ Jobs are cancelled by ID if they have it """
+        self.assertEqual(self.wm._build_job_cancellation_call(
+            'job', {'type': 'SBATCH'}, self.logger), "scancel --name job")
+        self.assertEqual(self.wm._build_job_cancellation_call(
+            'job', {'type': 'SBATCH'}, self.logger, job_id='12345'),
+            "scancel 12345")
+
+    def _mock_streams(self, pool, *outputs):
+        """ Streams of the calls made on the pooled connection """
+        streams = []
+        for lines, exit_code in outputs:
+            stream = mock.MagicMock(exit_code=exit_code, stderr='error')
+            stream.__enter__.return_value = stream
+            stream.__iter__.return_value = iter(lines)
+            streams.append(stream)
+        client = pool.return_value.connection.return_value.__enter__.\
+            return_value
+        client.stream_shell_command.side_effect = streams
+        return client
+
+    def test_get_states_queued(self):
+        """ Jobs in the queue are only read from squeue """
+        with mock.patch('croupier_plugin.workload_managers.slurm.'
+                        'SshPool') as pool:
+            client = self._mock_streams(
+                pool, ([u"12345|job1|RUNNING\n",
+                        u"12346|job2|PENDING\n"], 0))
+
+            states = self.wm.get_states('dir', {'host': 'hpc'},
+                                        ['job1', 'job2'], self.logger,
+                                        job_ids={'job1': '12345'})
+
+        self.assertEqual(states, {'job1': 'RUNNING', 'job2': 'PENDING'})
+        client.stream_shell_command.assert_called_once_with(
+            "squeue -h -u \"$(id -un)\" -o '%i|%j|%T' --name=job1,job2",
+            workdir='dir')
+
+    def test_get_states_finished(self):
+        """ Jobs that left the queue are looked up in sacct, by ID if they
+        have one and since they were sent if not """
+        with mock.patch('croupier_plugin.workload_managers.slurm.'
+                        'SshPool') as pool, \
+                mock.patch('croupier_plugin.workload_managers.slurm.'
+                           'time') as clock:
+            clock.time.return_value = 10000
+            client = self._mock_streams(
+                pool,
+                ([u"12347|job3|RUNNING\n"], 0),
+                ([u"12345|job1|COMPLETED\n",
+                  u"12300|job2|FAILED\n",
+                  u"12346|job2|CANCELLED by 1000\n"], 0))
+
+            states = self.wm.get_states('dir', {'host': 'hpc'},
+                                        ['job1', 'job2', 'job3'],
+                                        self.logger,
+                                        job_ids={'job1': '12345',
+                                                 'job2': '12346'},
+                                        submitted={'job1': 9000,
+                                                   'job2': 9500})
+
+            self.assertEqual(states, {'job1': 'COMPLETED',
+                                      'job2': 'CANCELLED',
+                                      'job3': 'RUNNING'})
+            self.assertEqual(client.stream_shell_command.call_args[0][0],
+                             "sacct -n -X -P -o JobID,JobName,State "
+                             "-j 12345,12346")
+
+            client = self._mock_streams(
+                pool,
+                ([], 0),
+                ([u"12345|job1|COMPLETED\n"], 0))
+            self.wm.get_states('dir', {'host': 'hpc'}, ['job1'],
+                               self.logger, submitted={'job1': 9000})
+
+            self.assertEqual(client.stream_shell_command.call_args[0][0],
+                             "sacct -n -X -P -o JobID,JobName,State "
+                             "-S now-4600 --name=job1")
+
+    def test_get_states_failed(self):
+        """ States found are kept if sacct fails """
+        with mock.patch('croupier_plugin.workload_managers.slurm.'
+                        'SshPool') as pool:
+            self._mock_streams(pool, ([u"1|job1|RUNNING\n"], 0), ([], 1))
+            self.assertEqual(self.wm.get_states('dir', {'host': 'hpc'},
+                                                ['job1', 'job2'],
+                                                self.logger),
+                             {'job1': 'RUNNING'})
+
+            self._mock_streams(pool, ([], 1))
+            self.assertEqual(self.wm.get_states('dir', {'host': 'hpc'},
+                                                ['job1'],
+                                                self.logger), {})
+
+    def test_parse_array_states(self):
+        """ Tasks of job arrays are matched by the ID of the array """
+        parsed = self.wm._parse_states("12345_1|job1|COMPLETED\n"
+                                       "12345_2|job1|RUNNING\n"
+                                       "12346|other|RUNNING\n",
+                                       None,
+                                       ['job1'],
+                                       {'job1': '12345'})
+
+        self.assertDictEqual(parsed, {'job1': 'RUNNING'})
+
     def test_parse_jobid(self):
         """ Parse JobID from sacct """
         parsed = self.wm._parse_states("test1|012345\n"
@@ -247,6 +453,16 @@ class TestSlurm(unittest.TestCase):
                                       'test2': '123456',
                                       'test3': '234567'})
 
+    def test_parse_streamed_states(self):
+        """ Parse sacct lines as they are streamed """
+        parsed = self.wm._parse_states(iter([u"test1|RUNNING\n",
+                                             u"test2|PENDING\n",
+                                             u"test1|FAILED\n"]),
+                                       None)
+
+        self.assertDictEqual(parsed, {'test1': 'FAILED',
+                                      'test2': 'PENDING'})
+
     def test_parse_clean_sacct(self):
         """ Parse no output from sacct """
         parsed = self.wm._parse_states("\n", None)
@@ -0,0 +1,206 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+@author: Javier Carnero
+         Atos Research & Innovation, Atos Spain S.A.
+         e-mail: javier.carnero@atos.net
+
+ssh_server.py: Local stub ssh server that runs the commands on this host
+'''
+
+
+import os
+import select
+import socket
+import subprocess
+import threading
+
+import paramiko
+
+USER = 'user'
+PASSWORD = 'pass'
+
+_HOST_KEY = paramiko.RSAKey.generate(1024)
+
+
+class _StubServer(paramiko.ServerInterface):
+
+    def __init__(self, stub):
+        self._stub = stub
+        self.forwards = {}
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if username == USER and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if username == USER:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        self._stub.commands.append(command)
+        _start(_run, channel, ['sh', '-c', command])
+        return True
+
+    def check_channel_shell_request(self, channel):
+        self._stub.commands.append(None)
+        _start(_run, channel, ['sh'])
+        return True
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self._stub.forwards.append(destination)
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_global_request(self, kind, msg):
+        return True
+
+
+class StubSshServer(object):
+    """ Ssh server listening on localhost that executes commands locally """
+
+    def __init__(self):
+        self.commands = []
+        self.forwards = []
+        self.connections = 0
+        self.transports = []
+        self._acceptors = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', 0))
+        self._sock.listen(50)
+        self.port = self._sock.getsockname()[1]
+        self._closed = False
+        _start(self._serve)
+
+    def credentials(self, **kwargs):
+        credentials = {'host': '127.0.0.1',
+                       'port': self.port,
+                       'user': USER,
+                       'password': PASSWORD}
+        credentials.update(kwargs)
+        return credentials
+
+    def close(self):
+        self._closed = True
+        self._sock.close()
+        for transport in self.transports:
+            transport.close()
+        for acceptor in self._acceptors:
+            acceptor.join()
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            self.connections += 1
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_HOST_KEY)
+            transport.use_compression(True)
+            server = _StubServer(self)
+            try:
+                transport.start_server(server=server)
+            except (paramiko.SSHException, EOFError, socket.error):
+                # the client went away during the handshake
+                transport.close()
+                continue
+            self.transports.append(transport)
+            self._acceptors.append(
+                _start(self._accept_forwards, transport, server))
+
+    def _accept_forwards(self, transport, server):
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None and channel.chanid in server.forwards:
+                _start(_relay, channel, server.forwards[channel.chanid])
+
+
+def _start(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _run(channel, argv):
+    process = subprocess.Popen(argv,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    _start(_feed_stdin, channel, process.stdin)
+    stderr = _start(_pump, process.stderr, channel.sendall_stderr)
+    _pump(process.stdout, channel.sendall)
+    stderr.join()
+    exit_code = process.wait()
+    if exit_code < 0:  # killed by a signal
+        exit_code = 128 - exit_code
+    try:
+        channel.send_exit_status(exit_code)
+        channel.shutdown_write()
+    except (paramiko.SSHException, EOFError, socket.error):
+        pass  # the client closed the channel or the connection
+    channel.close()
+
+
+def _feed_stdin(channel, stdin):
+    while True:
+        data = channel.recv(32768)
+        if not data:
+            break
+        stdin.write(data)
+        stdin.flush()
+    stdin.close()
+
+
+def _pump(stream, send):
+    while True:
+        data = os.read(stream.fileno(), 32768)
+        if not data:
+            break
+        send(data)
+
+
+def _relay(channel, destination):
+    target = socket.create_connection(destination)
+    while True:
+        readq, _, _ = select.select([channel, target], [], [])
+        if channel in readq:
+            data = channel.recv(32768)
+            if not data:
+                break
+            target.sendall(data)
+        if target in readq:
+            data = target.recv(32768)
+            if not data:
+                break
+            channel.sendall(data)
+    channel.close()
+    target.close()
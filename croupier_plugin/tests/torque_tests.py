@@ -169,6 +169,21 @@ class TestTorque(unittest.TestCase):
                                                         {'type': 'SBATCH'},
                                                         self.logger)
         self.assertEqual(response, "qselect -N test | xargs qdel")
+        response = self.wm._build_job_cancellation_call('test',
+                                                        {'type': 'SBATCH'},
+                                                        self.logger,
+                                                        job_id='1.server')
+        self.assertEqual(response, "qdel 1.server")
+
+    def test_parse_job_id(self):
+        """ Job ID given by qsub """
+        self.assertEqual(self.wm._parse_job_id("12.torque.local\n",
+                                               {'type': 'SBATCH'}),
+                         "12.torque.local")
+        self.assertEqual(self.wm._parse_job_id("pre\n12[].torque.local\n",
+                                               {'type': 'SBATCH'}),
+                         "12[].torque.local")
+        self.assertIsNone(self.wm._parse_job_id("", {'type': 'SBATCH'}))
 
     @unittest.skip("deprecated")
     def test_identifying_job_ids_call(self):
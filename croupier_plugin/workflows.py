@@ -29,7 +29,7 @@ import time
 
 from cloudify.decorators import workflow
 from cloudify.workflows import ctx, api, tasks
-from croupier_plugin.job_requester import JobRequester
+from croupier_plugin.monitor_service import get_requester
 
 LOOP_PERIOD = 1
 
@@ -70,6 +70,12 @@ class JobGraphInstance(object):
                 self.monitor_config = runtime_properties["credentials"]
 
             self.monitor_period = int(runtime_properties["monitor_period"])
+            self.monitor_events = runtime_properties.get("monitor_events",
+                                                         False)
+            self.max_time = parent.cfy_node.properties.get(
+                'job_options', {}).get('max_time')
+            self.job_id = runtime_properties.get("job_id")
+            self.submitted_at = None
 
             # build job name
             instance_components = instance.id.split('_')
@@ -95,6 +101,11 @@ class JobGraphInstance(object):
         else:
             self.winstance.send_event('.. job queued')
             init_state = 'PENDING'
+            # ID given by the workload manager, if any
+            self.job_id = result.get()
+            self.submitted_at = time.time()
+            if not self.simulate:
+                get_requester().invalidate(self.host)
         self.set_status(init_state)
         return result.task
 
@@ -164,6 +175,8 @@ class JobGraphInstance(object):
                                                   kwargs={"name": self.name})
         self.winstance.send_event('.. job canceled')
         result.task.wait_for_terminated()
+        if not self.simulate:
+            get_requester().invalidate(self.host)
 
         self._status = 'CANCELLED'
 
@@ -334,7 +347,11 @@ class Monitor(object):
         self.timestamp = 0
         self.job_instances_map = job_instances_map
         self.logger = logger
-        self.jobs_requester = JobRequester()
+        self.jobs_requester = get_requester()
+
+    def close(self):
+        """Stops following the events of the jobs"""
+        self.jobs_requester.stop_followers()
 
     def update_status(self):
         """Gets all executing instances and update their state"""
@@ -354,8 +371,20 @@ class Monitor(object):
                                 'type': job_instance.monitor_type,
                                 'workdir': job_instance.workdir,
                                 'names': [job_instance.name],
-                                'period': job_instance.monitor_period
+                                'period': job_instance.monitor_period,
+                                'events': job_instance.monitor_events,
+                                'max_times': {},
+                                'ids': {},
+                                'submitted': {}
                             }
+                        monitor_jobs[job_instance.host]['max_times'][
+                            job_instance.name] = job_instance.max_time
+                        if job_instance.job_id:
+                            monitor_jobs[job_instance.host]['ids'][
+                                job_instance.name] = job_instance.job_id
+                        if job_instance.submitted_at:
+                            monitor_jobs[job_instance.host]['submitted'][
+                                job_instance.name] = job_instance.submitted_at
                     else:
                         job_instance.set_status('COMPLETED')
 
@@ -422,6 +451,7 @@ def run_jobs(**kwargs):  # pylint: disable=W0613
             else:
                 # Something went wrong in the node, cancel execution
                 cancel_all(monitor.get_executions_iterator())
+                monitor.close()
                 return
 
         # remove finished nodes
@@ -436,6 +466,7 @@ def run_jobs(**kwargs):  # pylint: disable=W0613
 
     if monitor.is_something_executing():
         cancel_all(monitor.get_executions_iterator())
+    monitor.close()
 
     ctx.logger.info(
         "------------------Workflow Finished-----------------------")
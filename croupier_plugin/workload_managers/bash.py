@@ -25,7 +25,7 @@ bash.py
 '''
 
 
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshPool
 from croupier_plugin.workload_managers import workload_manager
 
 
@@ -69,23 +69,25 @@ class Bash(workload_manager.WorkloadManager):
         response['call'] = bash_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def _build_job_cancellation_call(self,
+                                     name,
+                                     job_settings,
+                                     logger,
+                                     job_id=None):
         return "pkill -f " + name
 
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None, submitted=None):
         # TODO set start time of consulting
         # (sacct only check current day)
         call = "cat msomonitor.data"
 
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-
-        client.close_connection()
+        with SshPool().connection(credentials) as client:
+            output, exit_code = client.execute_shell_command(
+                call,
+                workdir=workdir,
+                wait_result=True)
 
         states = {}
         if exit_code == 0:
@@ -25,12 +25,23 @@ slurm.py: Holds the slurm functions
 '''
 
 
-from croupier_plugin.ssh import SshClient
+import re
+import time
+
+from croupier_plugin.ssh import SshPool
 from croupier_plugin.workload_managers.workload_manager import (
     WorkloadManager,
     get_prevailing_state)
 
 
+# Seconds the sacct window starts before the first job was sent, covering
+# the clock differences between the manager and the cluster
+SACCT_WINDOW_MARGIN = 3600
+
+# Job ID printed by sbatch --parsable
+_SBATCH_JOB_ID = re.compile(r'^(\d+)(?:;\S+)?\s*$', re.M)
+
+
 class Slurm(WorkloadManager):
     """ Slurm Workload Manger Driver """
 
@@ -149,9 +160,22 @@ class Slurm(WorkloadManager):
         response['call'] = slurm_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def _build_job_cancellation_call(self,
+                                     name,
+                                     job_settings,
+                                     logger,
+                                     job_id=None):
+        if job_id:
+            return "scancel " + job_id
         return "scancel --name " + name
 
+    def _parse_job_id(self, output, job_settings):
+        if job_settings['type'] != 'SBATCH':
+            return None
+        # sbatch --parsable prints "id" or "id;cluster"
+        job_ids = _SBATCH_JOB_ID.findall(output or '')
+        return job_ids[-1] if job_ids else None
+
     def _parse_slurm_job_settings(self, job_id, job_settings, prefix, suffix):
         _prefix = prefix if prefix else ''
         _suffix = suffix if suffix else ''
@@ -219,38 +243,107 @@ class Slurm(WorkloadManager):
         return _settings
 
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
-        # TODO set start time of consulting
-        # (sacct only check current day)
-        call = "sacct -n -o JobName,State -X -P --name=" + ','.join(job_names)
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None, submitted=None):
+        """ Jobs still in the queue are read from squeue, that is served by
+        the controller. Only the jobs that left it are looked up in the
+        accounting database with sacct, since a bit before they were
+        sent. """
+        job_ids = job_ids or {}
+        if not job_names:
+            return {}
+
+        with SshPool().connection(credentials) as client:
+            states = self._query_states(
+                client,
+                "squeue -h -u \"$(id -un)\" -o '%i|%j|%T' --name=" +
+                ','.join(job_names),
+                workdir,
+                job_names,
+                job_ids,
+                logger)
+            if states is None:
+                return {}
+
+            finished = [name for name in job_names if name not in states]
+            if finished:
+                states.update(self._query_states(
+                    client,
+                    self._build_sacct_call(finished, job_ids, submitted),
+                    workdir,
+                    finished,
+                    job_ids,
+                    logger) or {})
 
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
+        return states
 
-        client.close_connection()
-
-        states = {}
-        if exit_code == 0:
-            states = self._parse_states(output, logger)
-        else:
-            logger.warning("Failed to get states")
+    def _query_states(self, client, call, workdir, job_names, job_ids,
+                      logger):
+        """ States of the jobs listed by the call, None if it fails """
+        with client.stream_shell_command(call, workdir=workdir) as stream:
+            states = self._parse_states(stream, logger, job_names, job_ids)
 
+        if stream.exit_code != 0:
+            logger.warning("Failed to get states: " + stream.stderr)
+            return None
         return states
 
-    def _parse_states(self, raw_states, logger):
-        """ Parse two colums sacct entries into a dict """
-        jobs = raw_states.splitlines()
+    def _build_sacct_call(self, job_names, job_ids, submitted):
+        """ sacct calls on the jobs, by ID if they have one. Jobs looked up
+        by name are restricted to the time since they were sent. """
+        sacct = "sacct -n -X -P -o JobID,JobName,State"
+        calls = []
+        ids = [job_ids[name] for name in job_names if job_ids.get(name)]
+        if ids:
+            calls.append(sacct + " -j " + ','.join(ids))
+        names = [name for name in job_names if not job_ids.get(name)]
+        if names:
+            submitted = submitted or {}
+            times = [submitted[name] for name in names if submitted.get(name)]
+            if len(times) == len(names):
+                # relative to the clock of the cluster
+                calls.append(sacct + " -S now-" +
+                             str(int(time.time() - min(times)) +
+                                 SACCT_WINDOW_MARGIN) +
+                             " --name=" + ','.join(names))
+            else:  # since the start of the day
+                calls.append(sacct + " --name=" + ','.join(names))
+        return ' && '.join(calls)
+
+    def _parse_states(self, raw_states, logger, job_names=None, job_ids=None):
+        """ Parse squeue and sacct entries into a dict, in two columns (name
+        and state) or three (ID, name and state). Entries can be given as a
+        string or as an iterable of lines (e.g. a CommandStream).
+
+        With three columns, jobs sent with an ID are only matched by it, and
+        only the job_names are kept if they are given. """
+        if isinstance(raw_states, basestring):
+            raw_states = raw_states.splitlines()
+        job_ids = job_ids or {}
+        names_by_id = dict((job_id, name)
+                           for name, job_id in job_ids.iteritems())
         parsed = {}
-        if jobs and (len(jobs) > 1 or jobs[0] != ''):
-            for job in jobs:
-                first, second = job.strip().split('|')
-                if first in parsed:
-                    parsed[first] = get_prevailing_state(parsed[first], second)
-                else:
-                    parsed[first] = second
+        for job in raw_states:
+            job = job.strip()
+            if not job:
+                continue
+            fields = job.split('|')
+            if len(fields) == 3:
+                job_id, name, state = fields
+                # tasks of job arrays are listed as <id>_<index>
+                job_id = job_id.split('_')[0]
+                if job_id in names_by_id:
+                    name = names_by_id[job_id]
+                elif name in job_ids:
+                    continue  # same name, other job
+                if job_names is not None and name not in job_names:
+                    continue
+            else:
+                name, state = fields
+            state = state.split(' ')[0]  # e.g. "CANCELLED by 1000"
+            if name in parsed:
+                parsed[name] = get_prevailing_state(parsed[name], state)
+            else:
+                parsed[name] = state
 
         return parsed
@@ -0,0 +1,382 @@
+'''
+Copyright (c) 2019 Atos Spain SA. All rights reserved.
+
+This file is part of Croupier.
+
+Croupier is free software: you can redistribute it and/or modify it
+under the terms of the Apache License, Version 2.0 (the License) License.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT ANY WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT, IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
+OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+See README file for full disclaimer information and LICENSE file for full
+license information in the project root.
+
+slurm_rest.py: Holds the Slurm REST API (slurmrestd) functions
+'''
+
+
+import math
+from threading import Lock
+
+import requests
+
+from croupier_plugin.ssh import SshClient
+from croupier_plugin.workload_managers.slurm import SACCT_WINDOW_MARGIN, Slurm
+from croupier_plugin.workload_managers.workload_manager import (
+    _add_event_hooks,
+    parse_max_time)
+
+# Version of the REST API used if the credentials set none
+REST_API_VERSION = 'v0.0.36'
+
+# Seconds a call to the REST API waits for the answer
+REST_TIMEOUT = 30
+
+# PATH of the jobs if the user has none, slurmrestd requires an environment
+_JOB_PATH = '/usr/local/bin:/usr/bin:/bin'
+
+# Prints the working directory and the environment the jobs are sent from
+_ENVIRONMENT_CALL = 'pwd && env -0'
+
+# Multipliers to MB of the memory units
+_MEMORY_UNITS = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+
+_DYNAMIC_MARK = '# DYNAMIC VARIABLES\n'
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def get_session(url):
+    """ HTTP session of a slurmrestd endpoint, that keeps its connections
+    open for every job and user """
+    with _sessions_lock:
+        if url not in _sessions:
+            _sessions[url] = requests.Session()
+        return _sessions[url]
+
+
+class SlurmRestError(requests.RequestException):
+    """ Raised when slurmrestd answers a call with errors """
+    pass
+
+
+class SlurmRestClient(object):
+    """ Calls the REST API of slurmrestd with the token of a user """
+
+    def __init__(self, credentials):
+        self.url = credentials['rest_url'].rstrip('/')
+        self.version = credentials.get('rest_version', REST_API_VERSION)
+        self.user = credentials.get('rest_user', credentials.get('user'))
+        self._headers = {'X-SLURM-USER-NAME': self.user,
+                         'X-SLURM-USER-TOKEN': credentials['rest_token']}
+        self._session = get_session(self.url)
+
+    def get(self, path, params=None):
+        return self._call('GET', path, params=params)
+
+    def post(self, path, payload):
+        return self._call('POST', path, json=payload)
+
+    def delete(self, path):
+        return self._call('DELETE', path)
+
+    def _call(self, method, path, **kwargs):
+        """ Payload of the answer, raises requests.RequestException if the
+        call fails """
+        response = self._session.request(
+            method,
+            self.url + path.format(version=self.version),
+            headers=self._headers,
+            timeout=REST_TIMEOUT,
+            **kwargs)
+        try:
+            payload = response.json()
+        except ValueError:
+            response.raise_for_status()
+            raise requests.RequestException(
+                "Slurm REST answer is not JSON: " + response.text[:200])
+        errors = payload.get('errors') if isinstance(payload, dict) else None
+        if errors:
+            raise SlurmRestError(
+                "Slurm REST call failed: " +
+                '; '.join(str(error.get('error', error))
+                          if isinstance(error, dict) else str(error)
+                          for error in errors))
+        response.raise_for_status()
+        return payload
+
+
+class SlurmRest(Slurm):
+    """ Slurm Workload Manager Driver through the REST API of slurmrestd.
+    The jobs are sent, monitored and cancelled with HTTP calls on a
+    persistent connection, the working directory and the job files are
+    still managed over ssh.
+
+    The credentials set the API endpoint in 'rest_url' and the token in
+    'rest_token'. 'rest_user' (the ssh user by default) and 'rest_version'
+    are optional. """
+
+    def submit_job(self,
+                   ssh_client,
+                   name,
+                   job_settings,
+                   is_singularity,
+                   logger,
+                   workdir=None,
+                   context=None):
+        if not SshClient.check_ssh_client(ssh_client, logger):
+            return False
+
+        if is_singularity:
+            script = self._build_container_script(name,
+                                                  job_settings,
+                                                  logger)
+            if script is None:
+                return False
+            # single jobs log their transitions, a job array shares the name
+            if int(job_settings.get('scale', 1)) <= 1:
+                script = _add_event_hooks(script, name, workdir)
+        else:
+            script = self._build_job_script(name, job_settings, logger)
+            if script is None:
+                return False
+
+        # slurmrestd neither expands the paths like a shell, nor sends the
+        # jobs with the environment of the user as sbatch does
+        output, exit_code = ssh_client.execute_shell_command(
+            _ENVIRONMENT_CALL, workdir=workdir, wait_result=True)
+        if exit_code != 0 or not output or not output.strip():
+            logger.error("Couldn't read the environment of the job in '" +
+                         str(workdir) + "'")
+            return False
+        current_workdir, environment = _parse_environment(output)
+        if workdir:
+            workdir = current_workdir
+
+        job = self._build_job_description(name, job_settings, workdir,
+                                          context, environment)
+        if 'error' in job:
+            logger.error("Couldn't build the job to send: " + job['error'])
+            return False
+        if 'array' in job:
+            # map the orchestrator variables, as sbatch job arrays do
+            scale_max = int(job_settings.get('scale_max_in_parallel', 0))
+            script = script.replace(
+                _DYNAMIC_MARK,
+                _DYNAMIC_MARK +
+                "export SCALE_INDEX=$SLURM_ARRAY_TASK_ID\n" +
+                "export SCALE_COUNT=$SLURM_ARRAY_TASK_COUNT\n" +
+                "export SCALE_MAX=" +
+                str(scale_max if scale_max > 0 else job_settings['scale']) +
+                "\n",
+                1)
+
+        try:
+            response = SlurmRestClient(ssh_client.credentials).post(
+                '/slurm/{version}/job/submit',
+                {'script': script, 'job': job})
+        except requests.RequestException as err:
+            logger.error("Job submission of '" + name + "' failed: " +
+                         str(err))
+            return False
+        return str(response['job_id'])
+
+    def stop_job(self,
+                 ssh_client,
+                 name,
+                 job_options,
+                 is_singularity,
+                 logger,
+                 workdir=None,
+                 job_id=None):
+        if not SshClient.check_ssh_client(ssh_client, logger):
+            return False
+
+        try:
+            api = SlurmRestClient(ssh_client.credentials)
+            if job_id:
+                job_ids = [job_id]
+            else:
+                job_ids = [str(job['job_id']) for job in
+                           api.get('/slurm/{version}/jobs')['jobs']
+                           if job.get('name') == name and
+                           job.get('user_name', api.user) == api.user]
+            for cancelled in job_ids:
+                api.delete('/slurm/{version}/job/' + cancelled)
+        except requests.RequestException as err:
+            logger.error("Job cancellation of '" + name + "' failed: " +
+                         str(err))
+            return False
+        return True
+
+    def _build_job_script(self, name, job_settings, logger):
+        """ Batch script that runs the command of the job, the options are
+        set in the job description """
+        if not isinstance(job_settings, dict) or \
+                not isinstance(name, basestring) or \
+                'type' not in job_settings or 'command' not in job_settings:
+            logger.error("'type' and 'command' must be defined in job "
+                         "settings")
+            return None
+
+        script = '#!/bin/bash -l\n\n' + _DYNAMIC_MARK + '\n'
+        for entry in job_settings.get('pre', []):
+            script += entry + '\n'
+
+        if job_settings['type'] == 'SBATCH':
+            script += 'bash ' + job_settings['command'] + '\n'
+        elif job_settings['type'] == 'SRUN':
+            script += 'srun ' + job_settings['command'] + '\n'
+        else:
+            logger.error("Job type '" + job_settings['type'] +
+                         "' not supported")
+            return None
+
+        for entry in job_settings.get('post', []):
+            script += entry + '\n'
+        return script
+
+    def _build_job_description(self, name, job_settings, workdir, context,
+                               environment=None):
+        """ Job properties of the REST API from the job settings, with the
+        environment of the user and the context variables """
+        job_environment = {'PATH': _JOB_PATH}
+        job_environment.update(environment or {})
+        job_environment.update(context or {})
+        job = {
+            'name': name,
+            'environment': job_environment,
+            'standard_output': job_settings.get('stdout_file') or
+            name + '.out',
+            'standard_error': job_settings.get('stderr_file') or
+            name + '.err'
+        }
+        if workdir:
+            job['current_working_directory'] = workdir
+
+        if job_settings.get('max_time'):
+            seconds = parse_max_time(job_settings['max_time'])
+            if seconds is None:
+                return {'error': "Bad 'max_time': " +
+                        str(job_settings['max_time'])}
+            job['time_limit'] = int(math.ceil(seconds / 60.0))
+        if job_settings.get('memory'):
+            memory = _parse_memory(job_settings['memory'])
+            if memory is None:
+                return {'error': "Bad 'memory': " +
+                        str(job_settings['memory'])}
+            job['memory_per_node'] = memory
+
+        for setting, prop, cast in (('partition', 'partition', str),
+                                    ('nodes', 'nodes', int),
+                                    ('tasks', 'tasks', int),
+                                    ('tasks_per_node', 'tasks_per_node', int),
+                                    ('reservation', 'reservation', str),
+                                    ('qos', 'qos', str),
+                                    ('mail_user', 'mail_user', str),
+                                    ('mail_type', 'mail_type', str)):
+            if str(job_settings.get(setting, '')).strip():
+                job[prop] = cast(job_settings[setting])
+
+        if 'scale' in job_settings and int(job_settings['scale']) > 1:
+            job['array'] = '0-{}'.format(int(job_settings['scale']) - 1)
+            if int(job_settings.get('scale_max_in_parallel', 0)) > 0:
+                job['array'] += '%' + str(
+                    job_settings['scale_max_in_parallel'])
+        return job
+
+# Monitor
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None, submitted=None):
+        """ Jobs known by the controller are read from it. Only the jobs
+        that left it are looked up in the accounting database, since a bit
+        before they were sent. """
+        if not job_names:
+            return {}
+        job_ids = job_ids or {}
+        api = SlurmRestClient(credentials)
+
+        jobs = []
+        try:
+            for name in job_names:
+                if job_ids.get(name):
+                    try:
+                        jobs += api.get('/slurm/{version}/job/' +
+                                        job_ids[name])['jobs']
+                    except SlurmRestError:
+                        pass  # left the controller
+            # only jobs without ID need the list of all the jobs
+            if any(not job_ids.get(name) for name in job_names):
+                jobs += [job for job in
+                         api.get('/slurm/{version}/jobs')['jobs']
+                         if job.get('user_name', api.user) == api.user]
+        except (requests.RequestException, KeyError) as err:
+            logger.warning("Failed to get states: " + str(err))
+            return {}
+        states = self._parse_states(_state_lines(jobs),
+                                    logger,
+                                    job_names,
+                                    job_ids)
+
+        finished = [name for name in job_names if name not in states]
+        if finished:
+            params = {'users': api.user}
+            submitted = submitted or {}
+            times = [submitted[name] for name in finished
+                     if submitted.get(name)]
+            if len(times) == len(finished):
+                params['start_time'] = int(min(times) - SACCT_WINDOW_MARGIN)
+            try:
+                jobs = api.get('/slurmdb/{version}/jobs', params)['jobs']
+            except (requests.RequestException, KeyError) as err:
+                logger.warning("Failed to get states: " + str(err))
+            else:
+                states.update(self._parse_states(_state_lines(jobs),
+                                                 logger,
+                                                 finished,
+                                                 job_ids))
+
+        return states
+
+
+def _state_lines(jobs):
+    """ Jobs of the REST API as the id|name|state entries of squeue and
+    sacct """
+    for job in jobs:
+        state = job.get('job_state', job.get('state'))
+        if isinstance(state, dict):  # accounting database
+            state = state.get('current')
+        if isinstance(state, list):  # flags of the newer versions
+            state = state[0] if state else None
+        if state:
+            yield '{}|{}|{}'.format(job['job_id'], job['name'], state)
+
+
+def _parse_environment(output):
+    """ Working directory and environment variables printed by
+    _ENVIRONMENT_CALL """
+    workdir, _, variables = output.partition('\n')
+    environment = dict(variable.split('=', 1)
+                       for variable in variables.split('\0')
+                       if '=' in variable)
+    environment.pop('_', None)  # the env command itself
+    return workdir.strip(), environment
+
+
+def _parse_memory(memory):
+    """ MB of a Slurm memory size, None if it can not be parsed """
+    memory = str(memory).strip().upper()
+    try:
+        if memory[-1:] in _MEMORY_UNITS:
+            return int(math.ceil(float(memory[:-1]) *
+                                 _MEMORY_UNITS[memory[-1]]))
+        return int(memory)
+    except ValueError:
+        return None
@@ -26,8 +26,7 @@ spark.py
 import json
 # from time import gmtime, strftime
 from inspect import currentframe, getframeinfo
-from paramiko import AuthenticationException
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshPool
 from croupier_plugin.workload_managers.workload_manager import (
     WorkloadManager,
     get_prevailing_state)
@@ -89,7 +88,8 @@ class Spark(WorkloadManager):
         logger.info("{0}: response cmd: {1}".format(frameinfo.function, response))
         return response
 
-    def _build_job_cancellation_call(self, name, ssh_client, logger):
+    def _build_job_cancellation_call(self, name, ssh_client, logger,
+                                     job_id=None):
         frameinfo = getframeinfo(currentframe())
         logger.debug("{2}: {0} - {1}".format(frameinfo.filename,
                                              frameinfo.lineno,
@@ -241,7 +241,8 @@ class Spark(WorkloadManager):
         return _settings
 
 # monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None, submitted=None):
         states = {}
         frameinfo = getframeinfo(currentframe())
         logger.debug("{2}: {0} - {1}".format(frameinfo.filename,
@@ -250,24 +251,20 @@ class Spark(WorkloadManager):
         call = "curl http://{0}:`cat /security/secrets/{0}.mesos" + \
             "`@localhost:5050/frameworks"
 
-        for i in range(5):
-            try:
-                client = SshClient(credentials)
-                user = client._user
-            except AuthenticationException as ae:
-                logger.debug(ae)
-                import time
-                time.sleep(5)
-                continue
+        # transient connection failures are retried by the SshGovernor
+        with SshPool().connection(credentials) as client:
+            user = client._user
 
-        call_format = call.format(user)
-        logger.debug("{2}: cal_fmt: {0}, usr: {1}".format(call_format,
-                                                          user,
-                                                          frameinfo.function))
+            call_format = call.format(user)
+            logger.debug("{2}: cal_fmt: {0}, usr: {1}".format(
+                call_format,
+                user,
+                frameinfo.function))
 
-        output, exit_code = client.execute_shell_command(call_format,
-                                                         workdir=workdir,
-                                                         wait_result=True)
+            output, exit_code = client.execute_shell_command(
+                call_format,
+                workdir=workdir,
+                wait_result=True)
         if exit_code == 0:
             json_output = json.loads(output)
             states = self._parse_frameworks_states(json_output,
@@ -278,7 +275,6 @@ class Spark(WorkloadManager):
 
         logger.debug("{0}: job_state:{1}".format(frameinfo.function,
                                                  states))
-        client.close_connection()
         return states
 
     def _parse_frameworks_states(self, frameworks_json, job_name, logger):
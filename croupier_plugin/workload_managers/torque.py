@@ -25,10 +25,15 @@ torque.py
 '''
 
 
-from croupier_plugin.ssh import SshClient
+import re
+
+from croupier_plugin.ssh import SshPool
 from workload_manager import WorkloadManager
 from croupier_plugin.utilities import shlex_quote
 
+# Job ID printed by qsub
+_QSUB_JOB_ID = re.compile(r'^(\d+(?:\[\])?\.\S+)\s*$', re.M)
+
 
 class Torque(WorkloadManager):
     """ Holds the Torque functions. Acts similarly to the class `Slurm`."""
@@ -206,19 +211,33 @@ class Torque(WorkloadManager):
         response['call'] = torque_call
         return response
 
-    def _build_job_cancellation_call(self, name, job_settings, logger):
+    def _build_job_cancellation_call(self,
+                                     name,
+                                     job_settings,
+                                     logger,
+                                     job_id=None):
+        if job_id:
+            return "qdel {}".format(shlex_quote(job_id))
         return r"qselect -N {} | xargs qdel".format(shlex_quote(name))
 
+    def _parse_job_id(self, output, job_settings):
+        # qsub prints "id.server", "id[].server" for job arrays
+        job_ids = _QSUB_JOB_ID.findall(output or '')
+        return job_ids[-1] if job_ids else None
+
 # Monitor
-    def get_states(self, workdir, credentials, job_names, logger):
+    def get_states(self, workdir, credentials, job_names, logger,
+                   job_ids=None, submitted=None):
         return self._get_states_detailed(
             workdir,
             credentials,
             job_names,
-            logger) if len(job_names) > 0 else {}
+            logger,
+            job_ids) if len(job_names) > 0 else {}
 
     @staticmethod
-    def _get_states_detailed(workdir, credentials, job_names, logger):
+    def _get_states_detailed(workdir, credentials, job_names, logger,
+                             job_ids=None):
         """
         Get job states by job names
 
@@ -233,40 +252,40 @@ class Torque(WorkloadManager):
         Unlike `get_states_tabular` it parses output on host
         and uses several SSH commands.
         """
-        # identify job ids
-        call = "echo {} | xargs -n 1 qselect -N".format(
-            shlex_quote(' '.join(map(shlex_quote, job_names))))
-
-        client = SshClient(credentials)
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        job_ids = Torque._parse_qselect(output)
-        if not job_ids:
-            return {}
-
-        # get detailed information about jobs
-        call = "qstat -f {}".format(' '.join(map(str, job_ids)))
-
-        output, exit_code = client.execute_shell_command(
-            call,
-            workdir=workdir,
-            wait_result=True)
-        client.close_connection()
-        try:
-            job_states = Torque._parse_qstat_detailed(output)
-        except SyntaxError as e:
-            logger.warning(
-                "cannot parse state response for job ids=[{}]".format(
-                    ','.join(map(str, job_ids))))
-            logger.warning(
-                "{err}\n`qstat -f` output to parse:\n\\[\n{text}\n\\]".format(
-                    err=str(e), text=output))
-            # TODO: think whether error ignoring is better
-            #       for the correct lifecycle
-            raise e
+        known_ids = job_ids or {}
+        job_ids = [known_ids[name] for name in job_names
+                   if known_ids.get(name)]
+        job_names = [name for name in job_names if not known_ids.get(name)]
+
+        with SshPool().connection(credentials) as client:
+            if job_names:
+                # identify job ids of the jobs sent without them
+                call = "echo {} | xargs -n 1 qselect -N".format(
+                    shlex_quote(' '.join(map(shlex_quote, job_names))))
+                output, exit_code = client.execute_shell_command(
+                    call,
+                    workdir=workdir,
+                    wait_result=True)
+                job_ids += Torque._parse_qselect(output)
+            if not job_ids:
+                return {}
+
+            # get detailed information about jobs
+            call = "qstat -f {}".format(' '.join(map(str, job_ids)))
+
+            with client.stream_shell_command(call, workdir=workdir) as stream:
+                try:
+                    job_states = Torque._parse_qstat_detailed(stream)
+                except SyntaxError as e:
+                    logger.warning(
+                        "cannot parse state response for job ids=[{}]".format(
+                            ','.join(map(str, job_ids))))
+                    logger.warning(
+                        "{err}\n`qstat -f` errors:\n\\[\n{text}\n\\]"
+                        .format(err=str(e), text=stream.stderr))
+                    # TODO: think whether error ignoring is better
+                    #       for the correct lifecycle
+                    raise e
 
         return job_states
 
@@ -281,9 +300,13 @@ class Torque(WorkloadManager):
 
     @staticmethod
     def _parse_qstat_detailed(qstat_output):
-        from StringIO import StringIO
+        """ Parse `qstat -f` output, given as a string or as an iterable
+        of lines (e.g. a CommandStream) """
+        if isinstance(qstat_output, basestring):
+            from StringIO import StringIO
+            qstat_output = StringIO(qstat_output)
         jobs = {}
-        for job in Torque._tokenize_qstat_detailed(StringIO(qstat_output)):
+        for job in Torque._tokenize_qstat_detailed(qstat_output):
             # ignore job['Job_Id'], use identification by name
             name = job.get('Job_Name', '')
             state_code = job.get('job_state', None)
@@ -310,7 +333,7 @@ class Torque(WorkloadManager):
 
         # tokenizes stream output and
         job_attr_tokens = {}
-        for line_no, line in enumerate(fp.readlines()):
+        for line_no, line in enumerate(fp):
             line = line.rstrip('\n\r')  # strip trailing newline character
             if len(line) > 1:  # skip empty lines
                 # find match for the new attribute
@@ -27,7 +27,8 @@ workload_manager.py
 import string
 import random
 from datetime import datetime
-from croupier_plugin.ssh import SshClient
+from croupier_plugin.ssh import SshClient, SshPool, run_async
+from croupier_plugin.utilities import shlex_quote
 
 
 BOOTFAIL = 0
@@ -49,6 +50,15 @@ TASK_RUNNING = 15
 TASK_FINISHED = 16
 TASK_KILLED = 17
 
+# Alternative workdir names checked along with the preferred one
+WORKDIR_ALTERNATIVES = 2
+
+# Log of the state transitions of the jobs, in their working directory
+EVENTS_FILE = 'croupier.events'
+
+# Line of the container scripts after which the events are logged
+_EVENTS_MARK = '# DYNAMIC VARIABLES\n'
+
 JOBSTATESLIST = [
     "BOOT_FAIL",
     "CANCELLED",
@@ -113,6 +123,67 @@ _STATES_PRECEDENCE = [
 ]
 
 
+def _with_pooled_client(credentials, method, *args, **kwargs):
+    """ Calls the method with a pooled client connected with the
+    credentials as first argument """
+    with SshPool().connection(credentials) as client:
+        return method(client, *args, **kwargs)
+
+
+def events_path(workdir=None):
+    """ Path of the events log of a working directory, quoted for the
+    shell but still expanding its variables (e.g. $HOME) """
+    if not workdir:
+        return EVENTS_FILE
+    return '"' + workdir.rstrip('/') + '/' + EVENTS_FILE + '"'
+
+
+def event_call(name, state, workdir=None):
+    """ Call that logs a state transition of a job """
+    return ("printf '%s %s\\n' " + shlex_quote(name) + " " + state +
+            " >> " + events_path(workdir))
+
+
+def _add_event_hooks(script, name, workdir=None):
+    """ Makes a job script log when it starts running and how it ends.
+    Scripts stopped by a signal (scancel, time limit) end CANCELLED, as
+    the exit trap would see them succeed. Returns the script unchanged if
+    it has no place for them. """
+    if _EVENTS_MARK not in script:
+        return script
+    hooks = ("croupier_event() { " + event_call(name, '"$1"', workdir) +
+             "; }\n"
+             "trap 'croupier_status=$?; [ $croupier_status -eq 0 ] && "
+             "croupier_event COMPLETED || croupier_event FAILED' EXIT\n"
+             "trap 'trap - EXIT; croupier_event CANCELLED; exit 143' TERM\n"
+             "trap 'trap - EXIT; croupier_event CANCELLED; exit 130' INT\n"
+             "croupier_event RUNNING\n")
+    return script.replace(_EVENTS_MARK, _EVENTS_MARK + hooks, 1)
+
+
+def parse_max_time(max_time):
+    """ Seconds of a job time limit (minutes, minutes:seconds,
+    hours:minutes:seconds, days-hours, days-hours:minutes or
+    days-hours:minutes:seconds), None if it can not be parsed """
+    if max_time is None:
+        return None
+    try:
+        days = 0
+        max_time = str(max_time).strip()
+        if '-' in max_time:
+            days, max_time = max_time.split('-', 1)
+            parts = [int(part) for part in max_time.split(':')]
+            parts += [0] * (3 - len(parts))  # days-hours[:minutes[:seconds]]
+        else:
+            parts = [int(part) for part in max_time.split(':')]
+            if len(parts) < 3:  # minutes[:seconds]
+                parts = [0] + parts + [0] * (2 - len(parts))
+        hours, minutes, seconds = parts
+        return ((int(days) * 24 + hours) * 60 + minutes) * 60 + seconds
+    except ValueError:
+        return None
+
+
 def state_int_to_str(value):
     """state on its int value to its string value"""
     return JOBSTATESLIST[int(value)]
@@ -145,6 +216,9 @@ class WorkloadManager(object):
         if workload_manager == "SLURM":
             from slurm import Slurm
             return Slurm()
+        elif workload_manager == "SLURM_REST":
+            from slurm_rest import SlurmRest
+            return SlurmRest()
         elif workload_manager == "TORQUE":
             from torque import Torque
             return Torque()
@@ -183,7 +257,8 @@ class WorkloadManager(object):
         @rtype string
         @param context: Dictionary containing context env vars
         @rtype dictionary of strings
-        @return Slurm's job name sent. None if an error arise.
+        @return the job ID given by the workload manager, True if it gives
+            none. False if an error arise.
         """
         if not SshClient.check_ssh_client(ssh_client, logger):
             return False
@@ -196,6 +271,13 @@ class WorkloadManager(object):
             if script_content is None:
                 return False
 
+            # single jobs log their transitions, a job array shares the name
+            log_events = int(job_settings.get('scale', 1)) <= 1
+            if log_events:
+                script_content = _add_event_hooks(script_content,
+                                                  name,
+                                                  workdir)
+
             if not self._create_shell_script(ssh_client,
                                              name + ".script",
                                              script_content,
@@ -216,6 +298,7 @@ class WorkloadManager(object):
                         job_settings['scale_max_in_parallel']
         else:
             settings = job_settings
+            log_events = False
 
         # build the call to submit the job
         response = self._build_job_submission_call(name,
@@ -228,22 +311,38 @@ class WorkloadManager(object):
                 response['error'])
             return False
 
+        # calls run before the submission, with the error message prefix
+        preparation = []
+
         # prepare the scale env variables
         if 'scale_env_mapping_call' in response:
-            scale_env_mapping_call = response['scale_env_mapping_call']
-            output, exit_code = ssh_client.execute_shell_command(
-                scale_env_mapping_call,
-                workdir=workdir,
-                wait_result=True)
+            preparation.append((response['scale_env_mapping_call'],
+                                "Scale env vars mapping"))
+
+        # submit the job, in the same round trip as its preparation
+        call = response['call']
+        # logged first, so the job can't log its next state before
+        if log_events:
+            preparation.append((event_call(name, 'PENDING', workdir),
+                                "Job event logging"))
+        if settings['type'] != 'SPARK':
+            preparation.append((call, "Job submission"))
+        results = ssh_client.execute_shell_batch(
+            [prepare_call for prepare_call, _ in preparation],
+            env=context,
+            workdir=workdir,
+            fail_fast=True)
+        job_id = None
+        for (prepare_call, action), (output, _, exit_code) in \
+                zip(preparation, results):
             if exit_code != 0:
-                logger.error("Scale env vars mapping '" +
-                             scale_env_mapping_call +
-                             "' failed with code " +
-                             str(exit_code) + ":\n" + output)
+                logger.error(action + " '" + prepare_call +
+                             "' exited with code " + str(exit_code) +
+                             ":\n" + str(output))
                 return False
+            if prepare_call == call:
+                job_id = self._parse_job_id(output, settings)
 
-        # submit the job
-        call = response['call']
         if (settings['type'] == 'SPARK'):
             exit_code = ssh_client.execute_shell_command(
                 call,
@@ -255,22 +354,16 @@ class WorkloadManager(object):
             logger.debug("Job execution with exit code : " + str(exit_code))
             import time
             time.sleep(30)
-        else:
-            output, exit_code = ssh_client.execute_shell_command(
-                call,
-                env=context,
-                workdir=workdir,
-                wait_result=True)
+            if exit_code != 0:
+                logger.error("Job submission '" + call +
+                             "' exited with code " + str(exit_code))
+                return False
         # if (job_settings['type'] == 'SPARK'):
         #    output, exit_code = ssh_client.execute_shell_command(   \
         #        call, env=context, workdir=workdir, wait_result=False)
         # else:
         #    output, exit_code = ssh_client.execute_shell_command(   \
         #        call, env=context, workdir=workdir, wait_result=True)
-        if exit_code != 0:
-            logger.error("Job submission '" + call + "' exited with code " +
-                         str(exit_code) + ":\n" + output)
-            return False
 
         # Job is successfully submitted, get the framework ID info
         # to manage the jobs in future
@@ -278,7 +371,7 @@ class WorkloadManager(object):
             # Parse output to get the framework ID
         #    framework_id = _parse_spark_output(output)
             # Store framework_id in each executables
-        return True
+        return job_id or True
 
     def clean_job_aux_files(self,
                             ssh_client,
@@ -316,7 +409,8 @@ class WorkloadManager(object):
                  job_options,
                  is_singularity,
                  logger,
-                 workdir=None):
+                 workdir=None,
+                 job_id=None):
         """
         Stops a job from the HPC
 
@@ -328,6 +422,8 @@ class WorkloadManager(object):
         @param job_settings: dictionary with the job options
         @type is_singularity: bool
         @param is_singularity: True if the job is in a container
+        @type job_id: string
+        @param job_id: ID given to the job when it was sent, if any
         @rtype string
         @return Slurm's job name stopped. None if an error arise.
         """
@@ -336,10 +432,10 @@ class WorkloadManager(object):
 
         if job_options['type'] == "SPARK":
             call = self._build_job_cancellation_call(name, ssh_client,
-                                                     logger)
+                                                     logger, job_id=job_id)
         else:
             call = self._build_job_cancellation_call(name, job_options,
-                                                     logger)
+                                                     logger, job_id=job_id)
         if call is None:
             return False
 
@@ -349,13 +445,103 @@ class WorkloadManager(object):
             call,
             workdir=workdir)
 
+    def submit_job_async(self,
+                         credentials,
+                         name,
+                         job_settings,
+                         is_singularity,
+                         logger,
+                         workdir=None,
+                         context=None):
+        """
+        Sends a job to the HPC like submit_job, in the background through a
+        pooled connection
+
+        @type credentials: dictionary
+        @param credentials: ssh credentials of the HPC login node
+        @rtype AsyncResult
+        @return result of submit_job, given by its get() method
+        """
+        return run_async(_with_pooled_client,
+                         credentials,
+                         self.submit_job,
+                         name,
+                         job_settings,
+                         is_singularity,
+                         logger,
+                         workdir=workdir,
+                         context=context)
+
+    def stop_job_async(self,
+                       credentials,
+                       name,
+                       job_options,
+                       is_singularity,
+                       logger,
+                       workdir=None,
+                       job_id=None):
+        """
+        Stops a job from the HPC like stop_job, in the background through a
+        pooled connection
+
+        @type credentials: dictionary
+        @param credentials: ssh credentials of the HPC login node
+        @rtype AsyncResult
+        @return result of stop_job, given by its get() method
+        """
+        return run_async(_with_pooled_client,
+                         credentials,
+                         self.stop_job,
+                         name,
+                         job_options,
+                         is_singularity,
+                         logger,
+                         workdir=workdir,
+                         job_id=job_id)
+
+    def get_states_async(self,
+                         workdir,
+                         credentials,
+                         job_names,
+                         logger,
+                         job_ids=None,
+                         submitted=None):
+        """
+        Gets the states of the jobs like get_states, in the background
+
+        @rtype AsyncResult
+        @return result of get_states, given by its get() method
+        """
+        return run_async(self.get_states,
+                         workdir,
+                         credentials,
+                         job_names,
+                         logger,
+                         job_ids=job_ids,
+                         submitted=submitted)
+
     def create_new_workdir(self, ssh_client, base_dir, base_name, logger):
         workdir = self._get_time_name(base_name)
 
-        # we make sure that the workdir does not exists
+        # we make sure that the workdir does not exists, probing some
+        # alternative names at the same time only if it is already taken
         base_name = workdir
-        while self._exists_path(ssh_client, base_dir + "/" + workdir):
-            workdir = self._get_random_name(base_name)
+        candidates = [workdir]
+        while True:
+            exists = self._exists_paths(ssh_client,
+                                        [base_dir + "/" + candidate
+                                         for candidate in candidates])
+            free = [candidate for candidate, taken in zip(candidates, exists)
+                    if taken is False]
+            if free:
+                workdir = free[0]
+                break
+            if all(taken is None for taken in exists):
+                logger.warning("Failed to check the '" + base_dir +
+                               "' directory.")
+                return None
+            candidates = [self._get_random_name(base_name)
+                          for _ in range(WORKDIR_ALTERNATIVES + 1)]
 
         full_path = base_dir + "/" + workdir
         if ssh_client.execute_shell_command(
@@ -407,7 +593,8 @@ class WorkloadManager(object):
     def _build_job_cancellation_call(self,
                                      name,
                                      job_settings,
-                                     logger):
+                                     logger,
+                                     job_id=None):
         """
         Generates cancel command line as a string
 
@@ -415,6 +602,8 @@ class WorkloadManager(object):
         @param name: name of the job
         @type job_settings: dictionary
         @param job_settings: dictionary with the job options
+        @type job_id: string
+        @param job_id: ID given to the job when it was sent, if any
         @rtype string
         @return string to call slurm with its parameters.
             None if an error arise.
@@ -423,7 +612,8 @@ class WorkloadManager(object):
             "'_build_job_cancellation_call' not implemented.")
 
     # Monitor
-    def get_states(self, ssh_client, names, logger):
+    def get_states(self, workdir, credentials, names, logger, job_ids=None,
+                   submitted=None):
         """
         Get the states of the jobs names
 
@@ -431,38 +621,42 @@ class WorkloadManager(object):
         @param credentials: dictionary with the HPC SSH credentials
         @type names: list
         @param names: list of the job names to retrieve their states
+        @type job_ids: dictionary
+        @param job_ids: IDs given to the jobs when they were sent, by name.
+            Jobs with an ID are looked up by it.
+        @type submitted: dictionary
+        @param submitted: times the jobs were sent, by name. Bounds the
+            lookup of the jobs that already finished.
         @rtype dict
         @return a dictionary of job names and its states
         """
         raise NotImplementedError("'get_states' not implemented.")
 #   ##################################################
 
+    def _parse_job_id(self, output, job_settings):
+        """
+        Gets the ID of a job from the output of its submission call
+
+        @type output: string
+        @param output: output of the submission call
+        @type job_settings: dictionary
+        @param job_settings: dictionary with the job options
+        @rtype string
+        @return the job ID. None if the workload manager gives none.
+        """
+        return None
+
     def _create_shell_script(self,
                              ssh_client,
                              name,
                              script_content,
                              logger,
                              workdir=None):
-        # @TODO: why not to use ctx.download_resource and
-        #        ssh_client.open_sftp().put(...)?
-        # escape for echo command
-        script_data = script_content \
-            .replace("\\", "\\\\") \
-            .replace("$", "\\$") \
-            .replace("`", "\\`") \
-            .replace('"', '\\"')
-
-        create_call = "echo \"" + script_data + "\" >> " + name + \
-            "; chmod +x " + name
-        _, exit_code = ssh_client.execute_shell_command(
-            create_call,
-            workdir=workdir,
-            wait_result=True)
-
-        if exit_code != 0:
-            logger.error(
-                "failed to create script: call '" + create_call +
-                "', exit code " + str(exit_code))
+        if not ssh_client.upload(script_content,
+                                 name,
+                                 mode=0o755,
+                                 workdir=workdir):
+            logger.error("failed to create script '" + name + "'")
             return False
 
         return True
@@ -490,3 +684,11 @@ class WorkloadManager(object):
             return True
         else:
             return False
+
+    def _exists_paths(self, ssh_client, paths):
+        """ Checks several paths at once, in concurrent channels. Each path
+        is True if it exists, False if not and None if unknown """
+        results = ssh_client.run_many(['[ -d "' + path + '" ]'
+                                       for path in paths])
+        return [None if exit_code is None else exit_code == 0
+                for _, _, exit_code in results]